@@ -4,19 +4,44 @@
 import os
 import json
 
-from flask import request
+from itertools import combinations
+
+from flask import (
+    request,
+    Response,
+    stream_with_context
+)
 
 from api.app import app
 
-from api.helpers.sparql import add_type_label
+from api.helpers.sparql import (
+    add_type_label,
+    add_type_labels
+)
+from api.helpers.sparql.adjacency import AdjacencyIndexUnavailable
+from api.helpers.sparql.graph import RelationshipGraph
+from api.helpers.sparql.structs import RelationshipEngine
 from api.helpers.auth import authenticate
 from api.helpers import relabel_transactions
+from api.helpers.responses import (
+    dumps,
+    etag_for,
+    json_response
+)
 from api.helpers.validation import (
     validate_json,
     ValidationSchema
 )
 
 
+def request_engine():
+    """Returns the relationship engine requested in the JSON body, if any"""
+    if "engine" in request.json:
+        return RelationshipEngine(request.json["engine"])
+
+    return None
+
+
 @app.route("/")
 def index():
     return {
@@ -24,27 +49,124 @@ def index():
     }
 
 
+# Maximum number of entities of a catalogue page
+MAX_PAGE_SIZE = 1000
+
+
+@app.errorhandler(AdjacencyIndexUnavailable)
+def adjacency_index_unavailable(error):
+    return json_response({
+        "message": str(error)
+    }, status=503)
+
+
+def catalogue_unavailable():
+    return json_response({
+        "message": "The entity catalogue is loading, retry later"
+    }, status=503)
+
+
+def page_arguments(default_limit: int):
+    """Returns the offset and limit query parameters, with the limit
+    capped at MAX_PAGE_SIZE"""
+    offset = request.args.get("offset", 0, type=int)
+    limit = min(request.args.get("limit", default_limit, type=int), MAX_PAGE_SIZE)
+
+    return offset, limit
+
+
+def invalid_page():
+    return json_response({
+        "message": "offset and limit must not be negative"
+    }, status=400)
+
+
 @app.route("/entities")
 @authenticate
 def entities():
-    all_entities = app.sparql.entities()
+    """Lists all the entities of the catalogue, optionally filtered by
+    the `class` query parameter. Use /entities/search for pages"""
+    if not app.catalogue.ready:
+        return catalogue_unavailable()
 
-    return json.dumps({
-        "entities": all_entities
-    })
+    def all_entities():
+        _, entities = app.catalogue.page(class_iri=request.args.get("class"))
+
+        return {
+            "entities": entities
+        }
+
+    # The response only changes with the content of the catalogue, and
+    # its digest is the same in all the workers
+    return json_response(
+        all_entities,
+        etag=etag_for("entities", app.catalogue.digest, request.args.to_dict())
+    )
+
+
+@app.route("/entities/search")
+@authenticate
+def entities_search():
+    """Typeahead search over entity labels with the `q` query parameter,
+    optionally filtered by `class` and paginated with `offset`/`limit`.
+    Without `q` it pages through all the entities in label order"""
+    if not app.catalogue.ready:
+        return catalogue_unavailable()
+
+    offset, limit = page_arguments(default_limit=20)
+
+    if offset < 0 or limit < 0:
+        return invalid_page()
+
+    def search_page():
+        total, page = app.catalogue.search(
+            request.args.get("q", ""),
+            class_iri=request.args.get("class"),
+            offset=offset,
+            limit=limit
+        )
+
+        return {
+            "entities": page,
+            "total": total
+        }
+
+    return json_response(
+        search_page,
+        etag=etag_for("search", app.catalogue.digest, request.args.to_dict())
+    )
 
 
 @app.route("/triples-count")
 @authenticate
 def triples_count():
-    # FIXME: Check if GUOs affect this
-    countries_count = app.sparql.entity_count_for_class("http://w3id.org/um/cbcm/eu-cm-ontology#Country")
-    companies_count = app.sparql.entity_count_for_class("http://w3id.org/um/cbcm/eu-cm-ontology#Company")
-    persons_count = app.sparql.entity_count_for_class("http://w3id.org/um/cbcm/eu-cm-ontology#Person")
+    """Returns the number of distinct entities of the allowed classes
+    and the per-class breakdown, served from the class statistics.
+    Entities of several classes are counted once in `count` and in
+    each of their classes in `classes`"""
+    if not app.class_statistics.ready:
+        return json_response({
+            "message": "The class statistics are loading, retry later"
+        }, status=503)
 
-    return json.dumps({
-        "count": int(countries_count) + int(companies_count) + int(persons_count)
-    })
+    return json_response({
+        "count": app.class_statistics.total,
+        "classes": app.class_statistics.counts
+    }, etag=etag_for("triples-count", app.class_statistics.digest))
+
+
+@app.route("/cache-stats")
+@authenticate
+def cache_stats():
+    stats = {"results": None, "labels": None}
+
+    if app.sparql.cache is not None:
+        stats["results"] = app.sparql.cache.stats()
+
+    if app.sparql.label_cache is not None:
+        stats["labels"] = app.sparql.label_cache.stats()
+
+    return json_response(stats)
 
 
 @app.route("/entities/properties", methods=("POST", ))
@@ -54,7 +176,7 @@ def dataprops():
     iri = request.json["iri"]
     properties = app.sparql.entity_data_properties(iri)
 
-    return json.dumps({
+    return json_response({
         "properties": properties
     })
 
@@ -64,12 +186,28 @@ def dataprops():
 @validate_json(schema=ValidationSchema.QUERY)
 def query():
     entities_iris = request.json["entities"]
+    too_large = search_too_large(len(entities_iris) * (len(entities_iris) - 1) // 2)
 
-    (nodes, edges), raw_response = app.sparql.find_relationships(
-        entities_iris[0],
-        entities_iris[1],
-        max_distance=request.json["maxDistance"]
-    )
+    if too_large is not None:
+        return too_large
+
+    deadline = app.sparql.new_deadline()
+
+    if len(entities_iris) > 2:
+        graph, raw_response = app.sparql.find_relationships_multi(
+            entities_iris,
+            max_distance=request.json["maxDistance"],
+            engine=request_engine(),
+            deadline=deadline
+        )
+    else:
+        graph, raw_response = app.sparql.find_relationships(
+            entities_iris[0],
+            entities_iris[1],
+            max_distance=request.json["maxDistance"],
+            engine=request_engine(),
+            deadline=deadline
+        )
 
     if app.debug:
         # Log raw and processed responses to files if debugging
@@ -77,33 +215,217 @@ def query():
             raw_results_file.write(json.dumps(raw_response))
 
         with open("debug/processed-results.json", "w") as processed_results:
-            processed_results.write(json.dumps({
-                "nodes": nodes,
-                "edges": edges
-            }))
+            processed_results.write(json.dumps(graph.serialize(merge_edges=False)))
 
     # Retrieve rdfs:label instances for all nodes and edges
     add_type_label(
         endpoint=app.sparql,
-        nodes=nodes,
-        edges=edges,
+        graph=graph,
         ontology_prefix=os.environ["ONTOLOGY_PREFIX"],
-        chunk_size=50
+        deadline=deadline
     )
 
-    relabel_transactions(nodes)
-    edges = app.sparql.merge_edge_duplicates(edges)
+    relabel_transactions(graph)
+
+    return json_response({
+        **graph.serialize(),
+        "partial": is_partial(deadline),
+        "truncated": graph.truncated
+    })
 
-    # Create a list of classes in the output graph
-    class_list = [n["class"] for n in nodes]
-    class_list = list(set(class_list))
 
-    return json.dumps({
-        "nodes": nodes,
-        "edges": edges,
-        "classes": class_list
+def is_partial(deadline) -> bool:
+    """Returns whether the request deadline expired, in which case
+    the response only contains the paths found in time"""
+    return deadline is not None and deadline.expired
+
+
+def search_too_large(pair_count: int):
+    """Returns a 400 response if a search between pair_count pairs of
+    entities exceeds max_pair_distances, otherwise None"""
+    if pair_count * request.json["maxDistance"] <= app.max_pair_distances:
+        return None
+
+    return json_response({
+        "message": (
+            f"{pair_count} entity pairs up to distance {request.json['maxDistance']} "
+            f"exceed the limit of {app.max_pair_distances} pair distances"
+        )
+    }, status=400)
+
+
+def request_pairs():
+    """Returns the entity pairs of a batch query, either given as
+    `pairs` or as all the pairs of the `entities` list"""
+    if "entities" in request.json:
+        return list(combinations(request.json["entities"], 2))
+
+    # The relationships of a pair do not depend on its order
+    unique_pairs = {}
+
+    for entity1, entity2 in request.json["pairs"]:
+        unique_pairs.setdefault(frozenset((entity1, entity2)), (entity1, entity2))
+
+    return list(unique_pairs.values())
+
+
+@app.route("/query/batch", methods=("POST", ))
+@authenticate
+@validate_json(schema=ValidationSchema.BATCH)
+def query_batch():
+    """Finds the relationships of several entity pairs with one request.
+    With `merge` (the default) a single graph is returned, otherwise
+    one graph per pair. Labels and types are looked up once for all
+    the pairs"""
+    pairs = request_pairs()
+    too_large = search_too_large(len(pairs))
+
+    if too_large is not None:
+        return too_large
+
+    merge = request.json.get("merge", True)
+    deadline = app.sparql.new_deadline()
+    merged_graph = RelationshipGraph() if merge else None
+
+    if merge and "entities" in request.json:
+        # Merged searches between entities share the sub-queries
+        app.sparql.find_relationships_multi(
+            request.json["entities"],
+            max_distance=request.json["maxDistance"],
+            engine=request_engine(),
+            graph=merged_graph,
+            deadline=deadline
+        )
+
+        graphs = [merged_graph]
+    else:
+        graphs = app.sparql.find_relationships_batch(
+            pairs,
+            max_distance=request.json["maxDistance"],
+            engine=request_engine(),
+            graph=merged_graph,
+            deadline=deadline
+        )
+
+    unique_graphs = [merged_graph] if merge else graphs
+
+    add_type_labels(
+        endpoint=app.sparql,
+        graphs=unique_graphs,
+        ontology_prefix=os.environ["ONTOLOGY_PREFIX"],
+        deadline=deadline
+    )
+
+    for graph in unique_graphs:
+        relabel_transactions(graph)
+
+    if merge:
+        return json_response({
+            **merged_graph.serialize(),
+            "partial": is_partial(deadline),
+            "truncated": merged_graph.truncated
+        })
+
+    return json_response({
+        "graphs": [{
+            "entities": list(pair),
+            **graph.serialize(),
+            "truncated": graph.truncated
+        } for pair, graph in zip(pairs, graphs)],
+        "partial": is_partial(deadline)
     })
 
 
+@app.route("/query/stream", methods=("POST", ))
+@authenticate
+@validate_json(schema=ValidationSchema.QUERY)
+def query_stream():
+    """Streaming variant of /query. The response is a stream of
+    newline delimited JSON events:
+
+    - paths:    new nodes and edges found by a completed query
+    - patch:    labels and classes of the nodes and property labels
+    - done:     the list of classes in the output graph, whether the
+                search was cut short by the request deadline and
+                whether paths were left out by the result limits
+    """
+    entities_iris = request.json["entities"]
+    max_distance = request.json["maxDistance"]
+    engine = request_engine()
+    too_large = search_too_large(len(entities_iris) * (len(entities_iris) - 1) // 2)
+
+    if too_large is not None:
+        return too_large
+
+    deadline = app.sparql.new_deadline()
+
+    # The response can not turn into an error once streaming started
+    app.sparql.check_engine(engine)
+
+    def generate():
+        graph = RelationshipGraph()
+
+        if len(entities_iris) > 2:
+            # Searches between more than two entities join their
+            # results at the end, so the graph is sent at once
+            app.sparql.find_relationships_multi(
+                entities_iris,
+                max_distance=max_distance,
+                engine=engine,
+                graph=graph,
+                deadline=deadline
+            )
+
+            events = [(max_distance, graph.serialize_nodes(), graph.serialize_edges())]
+        else:
+            events = app.sparql.stream_relationships(
+                entities_iris[0],
+                entities_iris[1],
+                max_distance=max_distance,
+                engine=engine,
+                graph=graph,
+                deadline=deadline
+            )
+
+        for distance, new_nodes, new_edges in events:
+            yield dumps({
+                "event": "paths",
+                "distance": distance,
+                "nodes": new_nodes,
+                "edges": new_edges
+            }) + b"\n"
+
+        add_type_label(
+            endpoint=app.sparql,
+            graph=graph,
+            ontology_prefix=os.environ["ONTOLOGY_PREFIX"],
+            deadline=deadline
+        )
+
+        relabel_transactions(graph)
+
+        yield dumps({
+            "event": "patch",
+            "nodes": [{
+                "id": idx,
+                "label": graph.node_label(idx),
+                "class": graph.node_class(idx)
+            } for idx in range(len(graph))],
+            "properties": dict(zip(graph.properties, graph.property_labels))
+        }) + b"\n"
+
+        yield dumps({
+            "event": "done",
+            "classes": graph.class_list(),
+            "partial": is_partial(deadline),
+            "truncated": graph.truncated
+        }) + b"\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="application/x-ndjson"
+    )
+
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -8,7 +8,24 @@ from flask import Flask
 from flask_cors import CORS
 from dotenv import load_dotenv
 
+from api.helpers import AdaptiveChunkSize
+from api.helpers.catalogue import (
+    ClassStatistics,
+    EntityCatalogue
+)
+from api.helpers.cache import (
+    LRUCache,
+    LabelCache,
+    MemoryLabelCache,
+    ResultCache,
+    SQLiteCacheBackend
+)
+
 from api.helpers.sparql.endpoint import SPARQLEndpoint
+from api.helpers.sparql.structs import (
+    QueryBatching,
+    RelationshipEngine
+)
 
 
 load_dotenv()
@@ -21,11 +38,152 @@ os.makedirs("debug", exist_ok=True)
 
 try:
     config = json.loads(open("config.json").read())
+    cache = None
+
+    if config.get("cache_enabled", True):
+        shared_cache = None
+
+        if config.get("cache_shared_path"):
+            # Lets all the gunicorn workers share cache hits
+            shared_cache = SQLiteCacheBackend(
+                config["cache_shared_path"],
+                ttl=config.get("cache_ttl", 3600),
+                max_entries=config.get("cache_shared_max_entries", 100000)
+            )
+
+        cache = ResultCache(
+            local=LRUCache(
+                max_entries=config.get("cache_max_entries", 1024),
+                max_bytes=config.get("cache_max_bytes", 64 * 1024 * 1024),
+                ttl=config.get("cache_ttl", 3600)
+            ),
+            shared=shared_cache
+        )
+
+    if config.get("label_cache_path"):
+        label_cache = LabelCache(
+            config["label_cache_path"],
+            ttl=config.get("label_cache_ttl", 7 * 86400),
+            negative_ttl=config.get("label_cache_negative_ttl", 86400),
+            max_entries=config.get("label_cache_max_entries", 100000)
+        )
+    else:
+        # Labels are still cached, for the lifetime of the worker
+        label_cache = MemoryLabelCache(
+            ttl=config.get("label_cache_ttl", 7 * 86400),
+            negative_ttl=config.get("label_cache_negative_ttl", 86400),
+            max_entries=config.get("label_cache_max_entries", 100000)
+        )
+
     sparql = SPARQLEndpoint(
         allowed_object_properties=config["allowed_object_properties"],
-        allowed_entity_classes=config["allowed_entity_classes"]
+        allowed_entity_classes=config["allowed_entity_classes"],
+        max_concurrent_queries=config.get("max_concurrent_queries", 8),
+        connection_pool_size=config.get("connection_pool_size", 8),
+        query_timeout=config.get("query_timeout", 30.0),
+        cache=cache,
+        label_cache=label_cache,
+        relationship_engine=RelationshipEngine(
+            config.get("relationship_engine", "sparql")
+        ),
+        adjacency_index_ttl=config.get("adjacency_index_ttl", 86400),
+        adjacency_index_path=config.get("adjacency_index_path"),
+        query_batching=QueryBatching(
+            config.get("query_batching", "none")
+        ),
+        combined_label_queries=config.get("combined_label_queries", False),
+        label_chunk_size=AdaptiveChunkSize(
+            initial=config.get("label_chunk_size", 50),
+            target_latency=config.get("label_chunk_target_latency", 0.5),
+            max_query_length=config.get("max_query_length", 100000)
+        ),
+        result_page_size=config.get("result_page_size", 10000),
+        query_time_budget=config.get("query_time_budget", 4.0),
+        label_time_reserve=config.get("label_time_reserve", 1.0),
+        query_result_limit=config.get("query_result_limit", 5000),
+        max_paths=config.get("max_paths", 2000)
     )
 
     app.sparql = sparql
+
+    # Bounds the queries of a request between several entity pairs:
+    # the number of pairs times maxDistance may not exceed it
+    app.max_pair_distances = config.get("max_pair_distances", 600)
+
+    # The entity catalogue and the class statistics are loaded in the
+    # background so that the full entities scan never runs while
+    # serving a request. See start_background_refresh
+    app.catalogue = EntityCatalogue(
+        sparql.iter_entities,
+        refresh_interval=config.get("entity_catalogue_refresh_interval", 3600),
+        path=config.get("entity_catalogue_path")
+    )
+
+    app.class_statistics = ClassStatistics(
+        sparql.entity_counts_by_class,
+        sparql.allowed_entity_count,
+        refresh_interval=config.get("class_statistics_refresh_interval", 3600),
+        path=config.get("class_statistics_path")
+    )
+
+    # The adjacency index is only loaded if the index engine may be used
+    app.adjacency_index_enabled = config.get(
+        "adjacency_index_enabled",
+        sparql.relationship_engine == RelationshipEngine.INDEX
+    )
+
+    app.background_refresh_started = False
 except FileNotFoundError:
     raise FileNotFoundError("config.json not found")
+
+
+def background_refreshes() -> list:
+    """Returns the (artifact path setting, refresh) pairs of the data
+    loaded in the background"""
+    refreshes = [
+        ("entity_catalogue_path", app.catalogue),
+        ("class_statistics_path", app.class_statistics)
+    ]
+
+    if app.adjacency_index_enabled:
+        refreshes.append(("adjacency_index_path", app.sparql.adjacency))
+
+    return refreshes
+
+
+def missing_artifact_paths() -> list:
+    """Returns the artifact path settings of config.json which are not
+    set, among the ones of the data loaded in the background"""
+    return [key for key, refresh in background_refreshes() if refresh.path is None]
+
+
+def start_background_refresh(build: bool = True):
+    """Starts loading the entity catalogue, the class statistics and, if
+    enabled, the adjacency index in the background, once per process.
+
+    With build they are built from the SPARQL endpoint (and saved to
+    their artifact path, if configured). Otherwise they are reloaded
+    from the artifacts built by another process, which is what the
+    gunicorn workers do (see gunicorn.conf.py). Building takes longer
+    than the worker timeout, so a worker fails to start if an artifact
+    path is not set rather than building the data itself.
+    """
+    if app.background_refresh_started:
+        return
+
+    if not build and missing_artifact_paths():
+        raise RuntimeError(
+            f"{', '.join(missing_artifact_paths())} not set in config.json: "
+            "the gunicorn workers only load the data built by api.builder"
+        )
+
+    app.background_refresh_started = True
+
+    for _, refresh in background_refreshes():
+        refresh.start(build=build)
+
+
+@app.before_first_request
+def start_background_refresh_on_first_request():
+    # Development server, where no gunicorn hook starts the refresh
+    start_background_refresh(build=True)
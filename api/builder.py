@@ -0,0 +1,34 @@
+# Copyright (C) <2021>  <Kody Moodley and Walter Simoncini>
+# License: https://www.gnu.org/licenses/agpl-3.0.txt
+
+"""Builds the entity catalogue, the class statistics and the adjacency
+index (if enabled) and saves them to the artifact paths of config.json
+every time they are refreshed, so that the gunicorn workers only load
+them.
+
+Started by the gunicorn master (see gunicorn.conf.py), or manually with
+`python -m api.builder`.
+"""
+import logging
+import threading
+
+from api.app import missing_artifact_paths, start_background_refresh
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    missing_paths = missing_artifact_paths()
+
+    if missing_paths:
+        # The data would be built without being saved for the workers
+        raise SystemExit(f"{', '.join(missing_paths)} not set in config.json")
+
+    start_background_refresh(build=True)
+
+    # The refresh threads run until the process is stopped
+    threading.Event().wait()
+
+
+if __name__ == '__main__':
+    main()
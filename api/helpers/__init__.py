@@ -1,20 +1,98 @@
 # Copyright (C) <2021>  <Kody Moodley and Walter Simoncini>
 # License: https://www.gnu.org/licenses/agpl-3.0.txt
 
+import time
+import threading
+
+
 def chunks(lst, n):
     """Yield successive n-sized chunks from lst."""
     for i in range(0, len(lst), n):
         yield lst[i:i + n]
 
 
-def relabel_transactions(nodes):
-    """Given a list of nodes relabels transactions as tx_type#tx_id"""
+class Deadline():
+    """Time budget of a request, shared by all the SPARQL calls made
+    to serve it.
+
+    The calls are given the `remaining` time as timeout. Code that stops
+    because the budget ran out sets `expired`, so that the request can
+    flag its results as partial.
+
+    The last `reserved` seconds of the budget are not part of the
+    remaining time until `release` is called, so that the relationship
+    queries leave time for the label lookups.
+    """
+    def __init__(self, budget: float, reserved: float = 0.0) -> None:
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+        self.reserved = min(reserved, budget)
+        self.expired = False
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - self.reserved - time.monotonic())
+
+    def release(self):
+        """Makes the reserved time available to the following calls"""
+        self.reserved = 0.0
+
+
+class AdaptiveChunkSize():
+    """Chunk size of IRI lookup queries, tuned at runtime.
+
+    The size is capped so that a chunk of IRIs fits within
+    `max_query_length` characters. Within that cap it doubles after
+    each lookup whose chunks complete faster than `target_latency`
+    seconds and halves when they are slower, staying between `minimum`
+    and `maximum`.
+    """
+    def __init__(
+            self,
+            initial: int = 50,
+            minimum: int = 10,
+            maximum: int = 5000,
+            target_latency: float = 0.5,
+            max_query_length: int = 100000) -> None:
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.max_query_length = max_query_length
+
+        self._lock = threading.Lock()
+
+    def for_iris(self, iris: list) -> int:
+        """Returns the chunk size to use for a list of IRIs"""
+        if not iris:
+            return self.size
+
+        # Each IRI is written as "<iri> " in the query
+        average_length = sum(len(iri) + 3 for iri in iris) / len(iris)
+        length_cap = int(self.max_query_length // average_length)
+
+        return max(self.minimum, min(self.size, length_cap))
+
+    def record(self, chunk_size: int, elapsed: float):
+        """Updates the size given the latency of the chunk queries of a
+        lookup, once per lookup. The chunks of a lookup run concurrently,
+        so recording each of them would double or halve the size once
+        per chunk"""
+        with self._lock:
+            if elapsed > self.target_latency:
+                self.size = max(self.minimum, self.size // 2)
+            elif chunk_size >= self.size:
+                # Only full chunks tell whether bigger ones are viable
+                self.size = min(self.maximum, self.size * 2)
+
+
+def relabel_transactions(graph):
+    """Given a relationship graph relabels transactions as tx_type#tx_id"""
     label_maps = {
         "http://w3id.org/um/cbcm/eu-cm-ontology#CrossBorderConversion": "CrossBorderConversion",
         "http://w3id.org/um/cbcm/eu-cm-ontology#CrossBorderDivision": "CrossBorderDivision",
         "http://w3id.org/um/cbcm/eu-cm-ontology#CrossBorderMerger": "CrossBorderMerger"
     }
 
-    for node in nodes:
-        if node["class"] in label_maps:
-            node["label"] = f"{label_maps[node['class']]}#{node['label']}"
+    for idx, node_class in enumerate(graph.classes):
+        if node_class in label_maps:
+            graph.labels[idx] = f"{label_maps[node_class]}#{graph.node_label(idx)}"
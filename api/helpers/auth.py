@@ -2,11 +2,12 @@
 # License: https://www.gnu.org/licenses/agpl-3.0.txt
 
 import os
-import json
 
 from flask import request
 from functools import wraps
 
+from api.helpers.responses import json_response
+
 
 def authenticate(f):
     @wraps(f)
@@ -14,9 +15,9 @@ def authenticate(f):
         api_key = request.headers.get("Api-Key")
 
         if api_key != os.environ["API_KEY"]:
-            return json.dumps({
+            return json_response({
                 "message": "Invalid API key"
-            }), 401
+            }, status=401)
 
         return f(*args, **kwargs)
 
@@ -0,0 +1,469 @@
+# Copyright (C) <2021>  <Kody Moodley and Walter Simoncini>
+# License: https://www.gnu.org/licenses/agpl-3.0.txt
+
+"""In-memory and shared caches for SPARQL results"""
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+
+def cache_key(namespace: str, *parts) -> str:
+    """Returns a stable cache key for a list of JSON serializable parts"""
+    digest = hashlib.sha1(
+        json.dumps(parts, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+    return f"{namespace}:{digest}"
+
+
+class LRUCache():
+    """Thread-safe LRU cache with TTL expiration and a memory budget.
+
+    Entries are evicted in least recently used order when either
+    `max_entries` or `max_bytes` is exceeded. The size of an entry is
+    estimated by the length of its JSON serialization.
+    """
+    def __init__(
+            self,
+            max_entries: int = 1024,
+            max_bytes: int = 64 * 1024 * 1024,
+            ttl: float = 3600) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self.size = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        """Returns the cached value for key or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return None
+
+            value, size, expires_at = entry
+
+            if expires_at < time.monotonic():
+                self._remove(key)
+                return None
+
+            self._entries.move_to_end(key)
+
+            return value
+
+    def set(self, key: str, value, size: int = None):
+        if size is None:
+            size = len(json.dumps(value))
+
+        if size > self.max_bytes:
+            # Never let a single entry flush the whole cache
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (value, size, time.monotonic() + self.ttl)
+            self.size += size
+
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key: str):
+        _, size, _ = self._entries.pop(key)
+        self.size -= size
+
+
+class SQLiteStore():
+    """Base class of the caches stored in a SQLite database file.
+
+    Several processes (e.g. gunicorn workers) can open the same
+    file to share cached entries, which also survive restarts.
+
+    Every PURGE_INTERVAL writes of a process the expired entries are
+    deleted and, if there are more than `max_rows`, the ones expiring
+    first, so that the file does not grow without bounds.
+    """
+    SCHEMA = ""
+    TABLE = ""
+
+    PURGE_INTERVAL = 1000
+
+    def __init__(self, path: str, max_rows: int = None) -> None:
+        self.path = path
+        self.max_rows = max_rows
+
+        self._local = threading.local()
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+
+        with self._connection() as conn:
+            conn.execute(self.SCHEMA)
+
+    def purge_expired(self):
+        """Deletes the expired entries, then the ones expiring first
+        beyond max_rows"""
+        with self._connection() as conn:
+            conn.execute(f"DELETE FROM {self.TABLE} WHERE expires_at <= ?", (time.time(), ))
+
+            if self.max_rows is None:
+                return
+
+            (rows, ) = conn.execute(f"SELECT COUNT(*) FROM {self.TABLE}").fetchone()
+
+            if rows > self.max_rows:
+                conn.execute(
+                    f"""DELETE FROM {self.TABLE} WHERE rowid IN (
+                        SELECT rowid FROM {self.TABLE} ORDER BY expires_at, rowid LIMIT ?
+                    )""",
+                    (rows - self.max_rows, )
+                )
+
+    def _record_writes(self, count: int = 1):
+        """Counts written entries and purges the store every
+        PURGE_INTERVAL of them"""
+        with self._writes_lock:
+            self._writes += count
+            purge = self._writes >= self.PURGE_INTERVAL
+
+            if purge:
+                self._writes = 0
+
+        if purge:
+            self.purge_expired()
+
+    def _connection(self) -> sqlite3.Connection:
+        # SQLite connections can not be shared between threads
+        conn = getattr(self._local, "conn", None)
+
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+
+            self._local.conn = conn
+
+        return conn
+
+
+class SQLiteCacheBackend(SQLiteStore):
+    """Cache backend storing JSON values in a SQLite database file,
+    holding at most `max_entries` of them"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS cache (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    """
+    TABLE = "cache"
+
+    def __init__(self, path: str, ttl: float = 3600, max_entries: int = 100000) -> None:
+        super().__init__(path, max_rows=max_entries)
+
+        self.ttl = ttl
+
+    def get(self, key: str):
+        row = self._connection().execute(
+            "SELECT value FROM cache WHERE key = ? AND expires_at > ?",
+            (key, time.time())
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        return json.loads(row[0])
+
+    def set(self, key: str, value):
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time() + self.ttl)
+            )
+
+        self._record_writes()
+
+
+class LabelCache(SQLiteStore):
+    """Persistent cache of per-IRI values such as labels and types.
+
+    Values are grouped by `kind` (e.g. "label"). IRIs without a value
+    are cached as negative entries, which expire after `negative_ttl`
+    seconds instead of `ttl`, so that they are not queried again on
+    every request. At most `max_entries` values are kept, see
+    SQLiteStore.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS iri_values (
+            kind TEXT NOT NULL,
+            iri TEXT NOT NULL,
+            value TEXT,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (kind, iri)
+        )
+    """
+    TABLE = "iri_values"
+
+    # Maximum number of parameters of a SQLite statement
+    MAX_PARAMETERS = 500
+
+    def __init__(
+            self,
+            path: str,
+            ttl: float = 7 * 86400,
+            negative_ttl: float = 86400,
+            max_entries: int = 100000) -> None:
+        super().__init__(path, max_rows=max_entries)
+
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        # Lookups run on the executor threads, so the statistics
+        # are updated under a lock
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def get_many(self, kind: str, iris: list):
+        """Returns a dictionary of the cached values of iris and the
+        list of iris not in the cache. Negative entries map to None"""
+        iris = list(dict.fromkeys(iris))
+        found = {}
+        conn = self._connection()
+        now = time.time()
+
+        for i in range(0, len(iris), self.MAX_PARAMETERS):
+            chunk = iris[i:i + self.MAX_PARAMETERS]
+            placeholders = ", ".join(["?"] * len(chunk))
+
+            rows = conn.execute(
+                f"""SELECT iri, value FROM iri_values
+                    WHERE kind = ? AND expires_at > ? AND iri IN ({placeholders})""",
+                (kind, now, *chunk)
+            )
+
+            found.update(rows)
+
+        missing = [iri for iri in iris if iri not in found]
+
+        with self._stats_lock:
+            self.hits += len(found)
+            self.misses += len(missing)
+
+        return found, missing
+
+    def put_many(self, kind: str, values: dict, missing: list = ()):
+        """Stores values, a dictionary mapping IRIs to values, and
+        negative entries for the missing IRIs"""
+        now = time.time()
+
+        rows = [
+            (kind, iri, value, now + self.ttl)
+            for iri, value in values.items()
+        ] + [
+            (kind, iri, None, now + self.negative_ttl)
+            for iri in missing
+        ]
+
+        with self._connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO iri_values (kind, iri, value, expires_at) VALUES (?, ?, ?, ?)",
+                rows
+            )
+
+        self._record_writes(len(rows))
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            hits, misses = self.hits, self.misses
+
+        lookups = hits + misses
+
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": hits / lookups if lookups else 0.0
+        }
+
+
+class MemoryLabelCache():
+    """In-memory variant of LabelCache, local to the process and
+    bounded to `max_entries` values, evicted in least recently used
+    order. Used when no label cache file is configured. As in
+    SQLiteStore, expired values are purged every PURGE_INTERVAL writes.
+    """
+    PURGE_INTERVAL = SQLiteStore.PURGE_INTERVAL
+
+    def __init__(
+            self,
+            ttl: float = 7 * 86400,
+            negative_ttl: float = 86400,
+            max_entries: int = 100000) -> None:
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def get_many(self, kind: str, iris: list):
+        """Returns a dictionary of the cached values of iris and the
+        list of iris not in the cache. Negative entries map to None"""
+        iris = list(dict.fromkeys(iris))
+        found = {}
+        now = time.monotonic()
+
+        with self._lock:
+            for iri in iris:
+                entry = self._entries.get((kind, iri))
+
+                if entry is None:
+                    continue
+
+                value, expires_at = entry
+
+                if expires_at <= now:
+                    del self._entries[(kind, iri)]
+                    continue
+
+                self._entries.move_to_end((kind, iri))
+                found[iri] = value
+
+            missing = [iri for iri in iris if iri not in found]
+
+            self.hits += len(found)
+            self.misses += len(missing)
+
+        return found, missing
+
+    def put_many(self, kind: str, values: dict, missing: list = ()):
+        """Stores values, a dictionary mapping IRIs to values, and
+        negative entries for the missing IRIs"""
+        now = time.monotonic()
+
+        with self._lock:
+            for iri, value in values.items():
+                self._entries[(kind, iri)] = (value, now + self.ttl)
+                self._entries.move_to_end((kind, iri))
+
+            for iri in missing:
+                self._entries[(kind, iri)] = (None, now + self.negative_ttl)
+                self._entries.move_to_end((kind, iri))
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+            self._writes += len(values) + len(missing)
+
+            if self._writes >= self.PURGE_INTERVAL:
+                self._writes = 0
+                self._purge_expired(now)
+
+    def purge_expired(self):
+        with self._lock:
+            self._purge_expired(time.monotonic())
+
+    def _purge_expired(self, now: float):
+        expired = [key for key, (_, expires_at) in self._entries.items() if expires_at <= now]
+
+        for key in expired:
+            del self._entries[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits, misses = self.hits, self.misses
+
+        lookups = hits + misses
+
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": hits / lookups if lookups else 0.0
+        }
+
+
+class ResultCache():
+    """Two-level cache: a local LRU cache in front of an optional
+    shared backend. Hits and misses are counted so that the cache
+    can be sized from its statistics.
+    """
+    def __init__(self, local: LRUCache, shared: SQLiteCacheBackend = None) -> None:
+        self.local = local
+        self.shared = shared
+
+        # Lookups run on the executor threads, so the statistics
+        # are updated under a lock
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def get(self, key: str):
+        value = self.local.get(key)
+
+        if value is not None:
+            with self._stats_lock:
+                self.hits += 1
+
+            return value
+
+        if self.shared is not None:
+            value = self.shared.get(key)
+
+            if value is not None:
+                # Promote the shared entry to the local cache
+                self.local.set(key, value)
+
+                with self._stats_lock:
+                    self.shared_hits += 1
+
+                return value
+
+        with self._stats_lock:
+            self.misses += 1
+
+        return None
+
+    def set(self, key: str, value):
+        self.local.set(key, value)
+
+        if self.shared is not None:
+            self.shared.set(key, value)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            hits, shared_hits, misses = self.hits, self.shared_hits, self.misses
+
+        lookups = hits + shared_hits + misses
+
+        return {
+            "hits": hits,
+            "shared_hits": shared_hits,
+            "misses": misses,
+            "hit_ratio": (hits + shared_hits) / lookups if lookups else 0.0,
+            "entries": len(self.local),
+            "bytes": self.local.size,
+            "max_bytes": self.local.max_bytes,
+            "evictions": self.local.evictions
+        }
@@ -0,0 +1,320 @@
+# Copyright (C) <2021>  <Kody Moodley and Walter Simoncini>
+# License: https://www.gnu.org/licenses/agpl-3.0.txt
+
+"""Materialized catalogue of the entities exposed by the API"""
+import os
+import abc
+import json
+import time
+import pickle
+import hashlib
+import logging
+import threading
+
+from bisect import bisect_left
+
+
+logger = logging.getLogger(__name__)
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def trigrams(text: str) -> set:
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def content_digest(value) -> str:
+    """Returns a digest of a JSON serializable value, which is the same
+    in every process that loads the same data"""
+    return hashlib.sha1(
+        json.dumps(value, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+class CatalogueIndex():
+    """Immutable search index over a list of entities.
+
+    - labels:       sorted (normalized label, entity index) pairs,
+                    used for prefix search with bisection
+    - trigrams:     maps each trigram of the normalized labels to the
+                    sorted indices of the entities containing it
+    - classes:      maps each class to the indices of its entities
+    - digest:       digest of the entities, see `content_digest`
+    """
+    def __init__(self, entities: list) -> None:
+        self.entities = entities
+        self.digest = content_digest(entities)
+        self.normalized_labels = [normalize(entity["label"]) for entity in entities]
+        self.labels = sorted(
+            (label, idx) for idx, label in enumerate(self.normalized_labels)
+        )
+
+        self.trigrams = {}
+        self.classes = {}
+
+        for label, idx in self.labels:
+            for trigram in trigrams(label):
+                self.trigrams.setdefault(trigram, []).append(idx)
+
+        for idx, entity in enumerate(entities):
+            self.classes.setdefault(entity["class"], []).append(idx)
+
+        for postings in self.trigrams.values():
+            postings.sort()
+
+    def prefix_matches(self, prefix: str) -> list:
+        """Returns the indices of the entities whose label starts
+        with prefix, in label order"""
+        matches = []
+
+        for label, idx in self.labels[bisect_left(self.labels, (prefix, -1)):]:
+            if not label.startswith(prefix):
+                break
+
+            matches.append(idx)
+
+        return matches
+
+    def substring_matches(self, text: str) -> list:
+        """Returns the indices of the entities whose label contains
+        text, which must be at least three characters long"""
+        postings = sorted(
+            (self.trigrams.get(trigram, []) for trigram in trigrams(text)),
+            key=len
+        )
+
+        candidates = set(postings[0])
+
+        for posting in postings[1:]:
+            candidates.intersection_update(posting)
+
+            if not candidates:
+                break
+
+        return sorted(
+            (idx for idx in candidates if text in self.normalized_labels[idx]),
+            key=lambda idx: self.normalized_labels[idx]
+        )
+
+
+class BackgroundRefresh(abc.ABC):
+    """Base class of the data loaded from the SPARQL endpoint in a
+    background thread and refreshed every `refresh_interval` seconds.
+    Subclasses implement `build`, which returns the loaded data, and
+    `apply`, which makes it current.
+
+    If a `path` is given the built data is also saved there, so that
+    other processes can `reload` it instead of building it again. The
+    gunicorn workers reload the data built once by `python -m api.builder`.
+    """
+    name = "background-refresh"
+
+    # Seconds between checks for a new artifact while reloading
+    reload_interval = 30
+
+    def __init__(self, refresh_interval: float = 3600, path: str = None) -> None:
+        self.refresh_interval = refresh_interval
+        self.path = path
+        self.loaded_at = None
+
+        self._artifact_mtime = None
+
+    @property
+    def ready(self) -> bool:
+        return self.loaded_at is not None
+
+    def start(self, build: bool = True):
+        """Starts building the data in a background thread, or, if build
+        is False, reloading it from `path` whenever it changes"""
+        thread = threading.Thread(
+            target=self._refresh_loop if build else self._reload_loop,
+            name=self.name,
+            daemon=True
+        )
+
+        thread.start()
+
+        return thread
+
+    @abc.abstractmethod
+    def build(self):
+        """Returns the data loaded from the SPARQL endpoint"""
+
+    @abc.abstractmethod
+    def apply(self, data):
+        """Makes the data returned by `build` current"""
+
+    def refresh(self):
+        """Builds the data, saves it to `path` if given and swaps it in"""
+        data = self.build()
+
+        if self.path is not None:
+            self._save(data)
+
+        self.apply(data)
+        self.loaded_at = time.time()
+
+    def reload(self) -> bool:
+        """Swaps in the data saved at `path` if it changed since the last
+        reload. Returns whether it was reloaded"""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+
+        if mtime == self._artifact_mtime:
+            return False
+
+        with open(self.path, "rb") as artifact:
+            self.apply(pickle.load(artifact))
+
+        self._artifact_mtime = mtime
+        self.loaded_at = time.time()
+
+        return True
+
+    def _save(self, data):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+
+        # Readers never see a partially written file
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+
+        with open(tmp_path, "wb") as artifact:
+            pickle.dump(data, artifact, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(tmp_path, self.path)
+
+    def _refresh_loop(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Could not load the %s", self.name)
+
+            if self.ready:
+                time.sleep(self.refresh_interval)
+            else:
+                # Retry sooner until the first load succeeds
+                time.sleep(min(self.refresh_interval, 60))
+
+    def _reload_loop(self):
+        while True:
+            try:
+                self.reload()
+            except Exception:
+                logger.exception("Could not reload the %s", self.name)
+
+            time.sleep(min(self.refresh_interval, self.reload_interval))
+
+
+class EntityCatalogue(BackgroundRefresh):
+    """Catalogue of entities loaded from the SPARQL endpoint in the
+    background and refreshed every `refresh_interval` seconds, so
+    that listing and searching entities never queries the endpoint.
+
+    `load_entities` is a callable returning an iterable of entity
+    dictionaries with the iri, label and class keys. The saved artifact
+    contains the whole index, so reloading it does not rebuild it.
+    """
+    name = "entity-catalogue"
+
+    def __init__(self, load_entities, refresh_interval: float = 3600, path: str = None) -> None:
+        super().__init__(refresh_interval, path=path)
+
+        self.load_entities = load_entities
+        self.index = None
+
+    @property
+    def digest(self) -> str:
+        return self.index.digest
+
+    def build(self):
+        return CatalogueIndex(list(self.load_entities()))
+
+    def apply(self, data):
+        self.index = data
+
+    def page(self, offset: int = 0, limit: int = None, class_iri: str = None):
+        """Returns the total number of entities (of a class, if given)
+        and a page of them"""
+        index = self.index
+
+        if class_iri is None:
+            entities = index.entities
+        else:
+            entities = [index.entities[idx] for idx in index.classes.get(class_iri, [])]
+
+        return len(entities), self._slice(entities, offset, limit)
+
+    def search(self, text: str, class_iri: str = None, offset: int = 0, limit: int = 20):
+        """Returns the number of entities matching text and a page of
+        them. Label prefix matches come before substring matches."""
+        index = self.index
+        text = normalize(text)
+
+        matches = index.prefix_matches(text)
+
+        if len(text) >= 3:
+            prefix_set = set(matches)
+            matches.extend([
+                idx for idx in index.substring_matches(text)
+                if idx not in prefix_set
+            ])
+
+        entities = [index.entities[idx] for idx in matches]
+
+        if class_iri is not None:
+            entities = [entity for entity in entities if entity["class"] == class_iri]
+
+        return len(entities), self._slice(entities, offset, limit)
+
+    def _slice(self, entities: list, offset: int, limit: int):
+        if offset < 0 or (limit is not None and limit < 0):
+            raise ValueError("offset and limit must not be negative")
+
+        if limit is None:
+            return entities[offset:]
+
+        return entities[offset:offset + limit]
+
+
+class ClassStatistics(BackgroundRefresh):
+    """Number of entities of each allowed class, loaded in the background
+    and refreshed every `refresh_interval` seconds.
+
+    `load_counts` is a callable returning a dictionary that maps class
+    IRIs to their number of entities, and `load_total` one returning
+    the number of distinct entities of all the classes. The total is
+    not the sum of the counts, since entities can have several classes.
+    """
+    name = "class-statistics"
+
+    def __init__(
+            self,
+            load_counts,
+            load_total,
+            refresh_interval: float = 3600,
+            path: str = None) -> None:
+        super().__init__(refresh_interval, path=path)
+
+        self.load_counts = load_counts
+        self.load_total = load_total
+        self.counts = {}
+        self.total = 0
+        self.digest = None
+
+    def build(self):
+        counts, total = self.load_counts(), self.load_total()
+
+        return {
+            "counts": counts,
+            "total": total,
+            "digest": content_digest([counts, total])
+        }
+
+    def apply(self, data):
+        self.counts = data["counts"]
+        self.total = data["total"]
+        self.digest = data["digest"]
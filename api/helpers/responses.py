@@ -0,0 +1,141 @@
+# Copyright (C) <2021>  <Kody Moodley and Walter Simoncini>
+# License: https://www.gnu.org/licenses/agpl-3.0.txt
+
+"""JSON serialization, compression and conditional requests for the
+API responses"""
+import json
+import gzip
+import hashlib
+
+from flask import request, Response
+
+try:
+    # Optional, much faster JSON encoder
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    # Optional, used if clients accept brotli compressed responses
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Smaller responses are not worth compressing
+MIN_COMPRESSED_SIZE = 1024
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def dumps(value) -> bytes:
+    """Serializes a value to compact UTF-8 encoded JSON"""
+    if orjson is not None:
+        return orjson.dumps(value)
+
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def etag_for(*parts) -> str:
+    """Returns a weak ETag for a list of JSON serializable parts that
+    identify the content of a response"""
+    digest = hashlib.sha1(
+        json.dumps(parts, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+    return f'W/"{digest}"'
+
+
+def not_modified(etag: str) -> bool:
+    """Returns whether the If-None-Match header of the request
+    matches etag"""
+    if_none_match = request.headers.get("If-None-Match")
+
+    if if_none_match is None:
+        return False
+
+    if if_none_match.strip() == "*":
+        return True
+
+    def opaque_tag(tag):
+        # Weak comparison, as required for If-None-Match
+        tag = tag.strip()
+
+        return tag[2:] if tag.startswith("W/") else tag
+
+    return opaque_tag(etag) in [opaque_tag(tag) for tag in if_none_match.split(",")]
+
+
+def accepted_encoding():
+    """Returns the preferred supported compression encoding of the
+    request Accept-Encoding header, or None"""
+    accepted = {}
+
+    for item in request.headers.get("Accept-Encoding", "").split(","):
+        encoding, _, params = item.strip().partition(";")
+        quality = 1.0
+
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+
+        accepted[encoding.strip().lower()] = quality
+
+    supported = ["br", "gzip"] if brotli is not None else ["gzip"]
+    encodings = [enc for enc in supported if accepted.get(enc, accepted.get("*", 0)) > 0]
+
+    if not encodings:
+        return None
+
+    # Ties prefer brotli, which compresses JSON better
+    return max(encodings, key=lambda enc: accepted.get(enc, accepted.get("*", 0)))
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def json_response(value, status: int = 200, etag: str = None) -> Response:
+    """Returns a JSON response, compressed if the client accepts it.
+
+    If an etag is given it is sent with the response, and a 304 response
+    is returned when it matches the If-None-Match request header. The
+    value is not serialized in that case, so it can be computed lazily
+    by passing a callable.
+    """
+    if etag is not None and not_modified(etag):
+        # Caches must key the 304 response like the full one
+        response = Response(status=304)
+        response.headers["ETag"] = etag
+        response.headers["Vary"] = "Accept-Encoding"
+
+        return response
+
+    if callable(value):
+        value = value()
+
+    body = dumps(value)
+    headers = {"Vary": "Accept-Encoding"}
+
+    if len(body) >= MIN_COMPRESSED_SIZE:
+        encoding = accepted_encoding()
+
+        if encoding is not None:
+            body = compress(body, encoding)
+            headers["Content-Encoding"] = encoding
+
+    if etag is not None:
+        headers["ETag"] = etag
+
+    return Response(
+        body,
+        status=status,
+        headers=headers,
+        mimetype="application/json"
+    )
@@ -1,47 +1,195 @@
 # Copyright (C) <2021>  <Kody Moodley and Walter Simoncini>
 # License: https://www.gnu.org/licenses/agpl-3.0.txt
 
-from api.helpers import chunks
+import time
+import statistics
+
+from api.helpers import chunks, Deadline
+from api.helpers.sparql.client import QUERY_TIMEOUT_ERRORS
+from api.helpers.sparql.graph import RelationshipGraph
 
 
 def add_type_label(
         endpoint,
-        nodes: list,
-        edges: list,
+        graph: RelationshipGraph,
         ontology_prefix: str,
-        chunk_size: int = 50):
-    # Extract IRIs
-    props = [e["iri"] for e in edges]
-    objects = [o["iri"] for o in nodes]
+        chunk_size: int = None,
+        deadline: Deadline = None):
+    """Adds labels and classes to the nodes of a relationship graph
+    and labels to its properties.
+
+    IRIs are looked up in chunks of `chunk_size` IRIs. If it is None the
+    chunk size is tuned by the endpoint from the measured latencies.
+
+    If a `deadline` is given, the chunks not fetched before it expires
+    are skipped and their IRIs keep their placeholder labels.
+    """
+    add_type_labels(
+        endpoint,
+        [graph],
+        ontology_prefix,
+        chunk_size=chunk_size,
+        deadline=deadline
+    )
 
-    # Chunk requests to avoid dbpedia limits
-    chunked_labels_entities = chunks(props + objects, chunk_size)
-    chunked_type_entities = chunks(objects, chunk_size)
+
+def add_type_labels(
+        endpoint,
+        graphs: list,
+        ontology_prefix: str,
+        chunk_size: int = None,
+        deadline: Deadline = None):
+    """Adds labels and classes to several relationship graphs, looking
+    up each IRI only once. See `add_type_label`"""
+    label_iris = list(dict.fromkeys(
+        iri for graph in graphs for iri in graph.properties + graph.iris
+    ))
+
+    type_iris = list(dict.fromkeys(
+        iri for graph in graphs for iri in graph.iris
+    ))
+    type_kind = f"type:{ontology_prefix}"
 
     labels_map, types_map = {}, {}
 
-    for chunk in chunked_labels_entities:
-        labels_map = {
-            **labels_map,
-            **endpoint.label_for_entities(chunk)
-        }
+    if endpoint.label_cache is not None:
+        # Only IRIs missing from the cache are queried
+        labels_map, label_iris = endpoint.label_cache.get_many("label", label_iris)
+        types_map, type_iris = endpoint.label_cache.get_many(type_kind, type_iris)
+
+    fetched_labels, fetched_types = fetch_labels_and_types(
+        endpoint,
+        label_iris=label_iris,
+        type_iris=type_iris,
+        ontology_prefix=ontology_prefix,
+        chunk_size=chunk_size,
+        deadline=deadline
+    )
+
+    if endpoint.label_cache is not None:
+        # IRIs of skipped chunks are not known to have no value
+        expired = deadline is not None and deadline.expired
+
+        endpoint.label_cache.put_many(
+            "label",
+            fetched_labels,
+            missing=[] if expired else [iri for iri in label_iris if iri not in fetched_labels]
+        )
+
+        endpoint.label_cache.put_many(
+            type_kind,
+            fetched_types,
+            missing=[] if expired else [iri for iri in type_iris if iri not in fetched_types]
+        )
 
-    for chunk in chunked_type_entities:
-        types_map = {
-            **types_map,
-            **endpoint.type_for_entities(chunk, ontology_prefix=ontology_prefix)
-        }
+    labels_map.update(fetched_labels)
+    types_map.update(fetched_types)
+
+    # Negative cache entries have no value
+    labels_map = {k: v for k, v in labels_map.items() if v is not None}
+    types_map = {k: v for k, v in types_map.items() if v is not None}
 
     # Add label and type information
-    for node in nodes:
-        if node["iri"] in labels_map:
-            node["label"] = labels_map[node["iri"]]
-
-        if node["iri"] in types_map:
-            node["class"] = types_map[node["iri"]]
-        else:
-            node["class"] = "Thing"
-
-    for edge in edges:
-        if edge["iri"] in labels_map:
-            edge["label"] = labels_map[edge["iri"]]
+    for graph in graphs:
+        graph.set_labels(labels_map)
+        graph.set_classes(types_map, default="Thing")
+
+
+def fetch_labels_and_types(
+        endpoint,
+        label_iris: list,
+        type_iris: list,
+        ontology_prefix: str,
+        chunk_size: int = None,
+        deadline: Deadline = None):
+    """Returns the label map of label_iris and the type map of
+    type_iris, querying the endpoint in concurrent chunks.
+
+    If the endpoint uses combined label queries, the label and type
+    of IRIs in both lists are fetched with a single query per chunk.
+    Chunks that time out because of the deadline are left out of the
+    maps, and `deadline.expired` is set. The time reserved by the
+    deadline for the label lookups is released.
+    """
+    if deadline is not None:
+        deadline.release()
+
+    # (chunk size, latency) of the completed chunk queries
+    latencies = []
+
+    def timed(fetch):
+        # Measures the chunk latencies for the adaptive chunk size
+        def timed_fetch(chunk):
+            start = time.perf_counter()
+
+            try:
+                result = fetch(chunk, None if deadline is None else deadline.remaining())
+            except QUERY_TIMEOUT_ERRORS:
+                if deadline is None:
+                    raise
+
+                deadline.expired = True
+
+                return {}, {}
+
+            latencies.append((len(chunk), time.perf_counter() - start))
+
+            return result
+
+        return timed_fetch
+
+    @timed
+    def fetch_labels(chunk, timeout):
+        return endpoint.label_for_entities(chunk, timeout=timeout), {}
+
+    @timed
+    def fetch_types(chunk, timeout):
+        return {}, endpoint.type_for_entities(
+            chunk,
+            ontology_prefix=ontology_prefix,
+            timeout=timeout
+        )
+
+    @timed
+    def fetch_labels_types(chunk, timeout):
+        return endpoint.label_and_type_for_entities(
+            chunk,
+            ontology_prefix=ontology_prefix,
+            timeout=timeout
+        )
+
+    if chunk_size is None:
+        chunk_size = endpoint.label_chunk_size.for_iris(label_iris + type_iris)
+
+    tasks = []
+
+    if endpoint.combined_label_queries:
+        label_set, type_set = set(label_iris), set(type_iris)
+        combined_iris = [iri for iri in label_iris if iri in type_set]
+
+        label_iris = [iri for iri in label_iris if iri not in type_set]
+        type_iris = [iri for iri in type_iris if iri not in label_set]
+
+        tasks.extend([
+            (fetch_labels_types, chunk)
+            for chunk in chunks(combined_iris, chunk_size)
+        ])
+
+    # Chunk requests to avoid dbpedia limits
+    tasks.extend([(fetch_labels, chunk) for chunk in chunks(label_iris, chunk_size)])
+    tasks.extend([(fetch_types, chunk) for chunk in chunks(type_iris, chunk_size)])
+
+    labels_map, types_map = {}, {}
+
+    for labels, types in endpoint.run_tasks(tasks):
+        labels_map.update(labels)
+        types_map.update(types)
+
+    if latencies:
+        # A single update per lookup, from the median chunk latency
+        endpoint.label_chunk_size.record(
+            max(size for size, _ in latencies),
+            statistics.median(elapsed for _, elapsed in latencies)
+        )
+
+    return labels_map, types_map
@@ -0,0 +1,389 @@
+# Copyright (C) <2021>  <Kody Moodley and Walter Simoncini>
+# License: https://www.gnu.org/licenses/agpl-3.0.txt
+
+"""In-memory adjacency index of the object-property subgraph, used to
+find relationships without generating SPARQL path queries"""
+import time
+
+from array import array
+from collections import deque
+from itertools import product
+
+from api.helpers import Deadline
+from api.helpers.catalogue import BackgroundRefresh
+from api.helpers.sparql.relationships import direct_layout, middle_object_layout
+
+
+# Number of edges followed by a path search between two checks of
+# the request deadline
+SEARCH_CHECK_INTERVAL = 1000
+
+
+class AdjacencyIndexUnavailable(Exception):
+    """Raised when the index engine is used before the adjacency
+    index is loaded"""
+    pass
+
+
+class SearchExpired(Exception):
+    """Raised when a path search runs out of time"""
+    pass
+
+
+class AdjacencyIndex():
+    """Compact adjacency index over integer node IDs.
+
+    IRIs of nodes and properties are interned to integers and the
+    adjacency lists are stored in CSR form: the neighbours of node `n`
+    are `neighbors[offsets[n]:offsets[n + 1]]`. Triples are indexed
+    in both directions, since paths follow edges both ways, and
+    `forward` records whether the triple goes from `n` to the neighbour.
+    """
+    def __init__(
+            self,
+            iris: list,
+            properties: list,
+            offsets: array,
+            neighbors: array,
+            edge_props: array,
+            forward: array) -> None:
+        self.iris = iris
+        self.properties = properties
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.edge_props = edge_props
+        self.forward = forward
+
+        self.node_ids = {iri: idx for idx, iri in enumerate(iris)}
+
+    @classmethod
+    def from_triples(cls, triples):
+        """Builds the index from an iterable of (subject, property,
+        object) IRI tuples"""
+        node_ids, iris = {}, []
+        prop_ids, properties = {}, []
+        subjects, props, objects = array("l"), array("l"), array("l")
+
+        def intern(iri, ids, values):
+            idx = ids.get(iri)
+
+            if idx is None:
+                idx = ids[iri] = len(values)
+                values.append(iri)
+
+            return idx
+
+        for s, p, o in triples:
+            if s == o:
+                # Self loops can not be part of a path
+                continue
+
+            subjects.append(intern(s, node_ids, iris))
+            props.append(intern(p, prop_ids, properties))
+            objects.append(intern(o, node_ids, iris))
+
+        # Count the degree of each node and turn the counts
+        # into offsets with a prefix sum
+        offsets = array("l", [0]) * (len(iris) + 1)
+
+        for s, o in zip(subjects, objects):
+            offsets[s + 1] += 1
+            offsets[o + 1] += 1
+
+        for idx in range(len(iris)):
+            offsets[idx + 1] += offsets[idx]
+
+        neighbors = array("l", [0]) * offsets[-1]
+        edge_props = array("l", [0]) * offsets[-1]
+        forward = array("b", [0]) * offsets[-1]
+        cursor = array("l", offsets)
+
+        for s, p, o in zip(subjects, props, objects):
+            for node, neighbor, is_forward in ((s, o, 1), (o, s, 0)):
+                pos = cursor[node]
+                neighbors[pos] = neighbor
+                edge_props[pos] = p
+                forward[pos] = is_forward
+                cursor[node] += 1
+
+        return cls(iris, properties, offsets, neighbors, edge_props, forward)
+
+    def __len__(self):
+        return len(self.iris)
+
+    def degree(self, node: int) -> int:
+        return self.offsets[node + 1] - self.offsets[node]
+
+    def node_degree(self, iri: str) -> int:
+        """Returns the degree of a node IRI, 0 if not in the index"""
+        idx = self.node_ids.get(iri)
+
+        return 0 if idx is None else self.degree(idx)
+
+    def path_collections(
+            self,
+            src: str,
+            dest: str,
+            max_distance: int,
+            limit: int = None,
+            ignored_objects: list = (),
+            deadline: Deadline = None) -> list:
+        """Returns the path collections that the relationship queries of
+        `get_queries` would return for src and dest, in the same order.
+
+        Paths follow the patterns of the queries: chains of edges all
+        pointing from src to dest or from dest to src, and chains from
+        both entities all pointing to a middle object or all pointing
+        away from it. The collections have the bindings and variable
+        layouts of the query results, so they are ranked and added to
+        graphs in the same way, with the same edge directions.
+
+        Intermediate objects are distinct and are neither src, dest nor
+        one of ignored_objects, as with NO_INTERMEDIATE_DUPLICATES. As
+        the LIMIT of the queries, each collection has at most `limit`
+        paths and is marked as truncated if it reaches it.
+
+        The search yields to the other greenlets of the worker every
+        SEARCH_CHECK_INTERVAL edges. If `deadline` expires it stops,
+        sets `deadline.expired` and returns the completed collections.
+        """
+        collections = []
+
+        if deadline is not None and deadline.remaining() <= 0:
+            deadline.expired = True
+            return collections
+
+        if src not in self.node_ids or dest not in self.node_ids:
+            return collections
+
+        src_id, dest_id = self.node_ids[src], self.node_ids[dest]
+
+        excluded = {src_id, dest_id}
+        excluded.update(self.node_ids[iri] for iri in ignored_objects if iri in self.node_ids)
+
+        check = self._search_check(deadline)
+
+        # Hops from each entity to the nodes that can be middle objects,
+        # following the edges forward (to_object) or backward
+        reachable = {
+            (node, forward): self._distances({node}, max_distance - 1, forward, excluded)
+            for node in (src_id, dest_id)
+            for forward in (True, False)
+        }
+
+        try:
+            for distance in range(1, max_distance + 1):
+                # FORWARD and BACKWARD direct connections
+                for start, end in ((src_id, dest_id), (dest_id, src_id)):
+                    collections.append(self._direct_collection(
+                        start, end, distance, limit, excluded, check
+                    ))
+
+                for a in range(1, distance):
+                    for to_object in (True, False):
+                        middles = set(
+                            node for node, hops in reachable[(src_id, to_object)].items()
+                            if hops <= a and reachable[(dest_id, to_object)].get(node, distance) <= distance - a
+                        ) - excluded
+
+                        collections.append(self._middle_object_collection(
+                            src_id, dest_id, a, distance - a, to_object, middles, limit, excluded, check
+                        ))
+        except SearchExpired:
+            deadline.expired = True
+
+        return collections
+
+    def _direct_collection(self, start: int, end: int, distance: int, limit: int, excluded: set, check) -> dict:
+        """Returns the paths of a direct connection query from start
+        to end, see `direct_layout`"""
+        hops_to_end = self._distances({end}, distance - 1, False, excluded)
+        paths = []
+
+        for props, nodes in self._chains(start, distance, True, {end}, hops_to_end, excluded, check):
+            binding = {f"pf{idx}": self._uri(self.properties[prop]) for idx, prop in enumerate(props, 1)}
+            binding.update({f"of{idx}": self._uri(self.iris[node]) for idx, node in enumerate(nodes[:-1], 1)})
+            paths.append(binding)
+
+            if limit is not None and len(paths) >= limit:
+                break
+
+        return self._collection(start, end, direct_layout(distance), paths, limit)
+
+    def _middle_object_collection(
+            self,
+            src: int,
+            dest: int,
+            dist1: int,
+            dist2: int,
+            to_object: bool,
+            middles: set,
+            limit: int,
+            excluded: set,
+            check) -> dict:
+        """Returns the paths of a middle object query between src and
+        dest, see `middle_object_layout`. The chains of both entities
+        are found separately and joined on the middle object"""
+        arms = []
+
+        for entity, distance in ((src, dist1), (dest, dist2)):
+            hops_to_middle = self._distances(middles, distance - 1, not to_object, excluded)
+            chains = {}
+
+            for props, nodes in self._chains(entity, distance, to_object, middles, hops_to_middle, excluded, check):
+                chains.setdefault(nodes[-1], []).append((props, nodes[:-1]))
+
+            arms.append(chains)
+
+        first_arms, second_arms = arms
+        paths = []
+
+        for middle, first_chains in first_arms.items():
+            for (first_props, first_nodes), (second_props, second_nodes) in product(
+                    first_chains,
+                    second_arms.get(middle, ())):
+                check()
+
+                if not set(first_nodes).isdisjoint(second_nodes):
+                    continue
+
+                binding = {"middle": self._uri(self.iris[middle])}
+
+                for fs, props, nodes in (("f", first_props, first_nodes), ("s", second_props, second_nodes)):
+                    binding.update({f"p{fs}{idx}": self._uri(self.properties[prop]) for idx, prop in enumerate(props, 1)})
+                    binding.update({f"o{fs}{idx}": self._uri(self.iris[node]) for idx, node in enumerate(nodes, 1)})
+
+                paths.append(binding)
+
+                if limit is not None and len(paths) >= limit:
+                    return self._collection(src, dest, middle_object_layout(dist1, dist2), paths, limit)
+
+        return self._collection(src, dest, middle_object_layout(dist1, dist2), paths, limit)
+
+    def _collection(self, src: int, dest: int, layout: dict, paths: list, limit: int) -> dict:
+        return {
+            "src": self.iris[src],
+            "dest": self.iris[dest],
+            "layout": layout,
+            "paths": paths,
+            "truncated": limit is not None and len(paths) >= limit
+        }
+
+    def _chains(self, start: int, length: int, forward: bool, targets: set, hops_to_target: dict, excluded: set, check):
+        """Yields the (properties, nodes) of the chains of `length` edges
+        from start to one of the targets, following the edges forward or
+        backward. nodes are the node IDs after start, all distinct.
+
+        Chains only go through the nodes which are not excluded and can
+        reach a target in the hops left, given by hops_to_target. The
+        neighbours of lowest degree are visited first, so that the paths
+        through hub nodes are the ones left out by a limit.
+        """
+        props, nodes = [], []
+
+        def visit(node):
+            remaining = length - len(nodes) - 1
+            edges = sorted(range(self.offsets[node], self.offsets[node + 1]), key=self._neighbor_degree)
+
+            for pos in edges:
+                if self.forward[pos] != forward:
+                    continue
+
+                check()
+                neighbor = self.neighbors[pos]
+
+                if neighbor in nodes:
+                    continue
+
+                if remaining == 0:
+                    if neighbor in targets:
+                        yield props + [self.edge_props[pos]], nodes + [neighbor]
+
+                    continue
+
+                if neighbor in excluded or hops_to_target.get(neighbor, length) > remaining:
+                    continue
+
+                props.append(self.edge_props[pos])
+                nodes.append(neighbor)
+
+                yield from visit(neighbor)
+
+                props.pop()
+                nodes.pop()
+
+        yield from visit(start)
+
+    def _distances(self, starts: set, max_depth: int, forward: bool, excluded: set) -> dict:
+        """Returns the hops from the nearest of starts of the nodes
+        within max_depth hops, following the edges forward or backward.
+        Excluded nodes are not traversed"""
+        distances = dict.fromkeys(starts, 0)
+        queue = deque(starts)
+
+        while queue:
+            node = queue.popleft()
+            depth = distances[node]
+
+            if depth >= max_depth:
+                continue
+
+            for pos in range(self.offsets[node], self.offsets[node + 1]):
+                neighbor = self.neighbors[pos]
+
+                if self.forward[pos] != forward or neighbor in distances or neighbor in excluded:
+                    continue
+
+                distances[neighbor] = depth + 1
+                queue.append(neighbor)
+
+        return distances
+
+    def _neighbor_degree(self, pos: int) -> int:
+        return self.degree(self.neighbors[pos])
+
+    def _search_check(self, deadline: Deadline = None):
+        """Returns a function called for each edge followed by a search,
+        which every SEARCH_CHECK_INTERVAL calls yields to the other
+        greenlets and raises SearchExpired if deadline expired"""
+        steps = 0
+
+        def check():
+            nonlocal steps
+            steps += 1
+
+            if steps % SEARCH_CHECK_INTERVAL:
+                return
+
+            # Under the gunicorn gevent workers sleep is patched and
+            # lets the other requests of the worker run
+            time.sleep(0)
+
+            if deadline is not None and deadline.remaining() <= 0:
+                raise SearchExpired()
+
+        return check
+
+    @staticmethod
+    def _uri(iri: str) -> dict:
+        return {"type": "uri", "value": iri}
+
+
+class BackgroundAdjacencyIndex(BackgroundRefresh):
+    """Adjacency index built in the background from the triples returned
+    by `load_triples` and rebuilt every `refresh_interval` seconds, so
+    that the full scan of the object-property subgraph never runs while
+    serving a request"""
+    name = "adjacency-index"
+
+    def __init__(self, load_triples, refresh_interval: float = 86400, path: str = None) -> None:
+        super().__init__(refresh_interval, path=path)
+
+        self.load_triples = load_triples
+        self.index = None
+
+    def build(self):
+        return AdjacencyIndex.from_triples(self.load_triples())
+
+    def apply(self, data):
+        self.index = data
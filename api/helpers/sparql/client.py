@@ -0,0 +1,530 @@
+# Copyright (C) <2021>  <Kody Moodley and Walter Simoncini>
+# License: https://www.gnu.org/licenses/agpl-3.0.txt
+
+"""Thread-safe SPARQL protocol client backed by a pool of keep-alive
+connections with per-connection digest authentication"""
+import os
+import re
+import json
+import socket
+import hashlib
+import threading
+import http.client
+
+from contextlib import contextmanager
+from urllib.parse import urlsplit, urlencode
+from urllib.request import parse_http_list, parse_keqv_list
+
+
+DIGEST_ALGORITHMS = {
+    "MD5": hashlib.md5,
+    "MD5-SESS": hashlib.md5,
+    "SHA-256": hashlib.sha256,
+    "SHA-256-SESS": hashlib.sha256
+}
+
+# Errors raised when a pooled connection was closed by the server
+# while idle. The request is retried once on a fresh connection
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    BrokenPipeError,
+    ConnectionResetError
+)
+
+
+XSD = "http://www.w3.org/2001/XMLSchema#"
+
+TSV_ESCAPES = re.compile(r"\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)")
+TSV_ESCAPE_CHARS = {"t": "\t", "b": "\b", "n": "\n", "r": "\r", "f": "\f"}
+
+# Marks where iter_bindings inserts the keyset pagination filter. It
+# is a comment, so queries containing it are valid without the filter
+KEYSET_FILTER = "# keyset filter"
+
+TSV_INTEGER = re.compile(r"^[+-]?[0-9]+$")
+TSV_DECIMAL = re.compile(r"^[+-]?[0-9]*\.[0-9]+$")
+
+
+def unescape_tsv_string(value: str) -> str:
+    def replace(match):
+        escape = match.group(1)
+
+        if escape[0] in "uU":
+            return chr(int(escape[1:], 16))
+
+        return TSV_ESCAPE_CHARS.get(escape, escape)
+
+    return TSV_ESCAPES.sub(replace, value)
+
+
+def sparql_string(value: str) -> str:
+    """Returns value as a SPARQL string literal"""
+    escaped = value.replace("\\", "\\\\").replace('"', '\\"')
+    escaped = escaped.replace("\n", "\\n").replace("\r", "\\r")
+
+    return f'"{escaped}"'
+
+
+def keyset_query(query: str, condition: str = None, limit: int = None) -> str:
+    """Returns query with KEYSET_FILTER replaced by a filter on
+    condition, if given, and limited to limit results"""
+    if condition is not None:
+        query = query.replace(KEYSET_FILTER, f"FILTER ({condition})")
+
+    if limit is not None:
+        query = f"{query}\nLIMIT {limit}"
+
+    return query
+
+
+def parse_tsv_term(term: str) -> dict:
+    """Parses an RDF term of a SPARQL TSV result into the format
+    of the SPARQL JSON results"""
+    if term.startswith("<"):
+        return {"type": "uri", "value": term[1:-1]}
+
+    if term.startswith("_:"):
+        return {"type": "bnode", "value": term[2:]}
+
+    if term.startswith('"'):
+        value, _, suffix = term[1:].rpartition('"')
+        literal = {"type": "literal", "value": unescape_tsv_string(value)}
+
+        if suffix.startswith("@"):
+            literal["xml:lang"] = suffix[1:]
+        elif suffix.startswith("^^"):
+            literal["datatype"] = suffix[3:-1]
+
+        return literal
+
+    # Abbreviated numeric and boolean literals
+    if term in ("true", "false"):
+        datatype = "boolean"
+    elif TSV_INTEGER.match(term):
+        datatype = "integer"
+    elif TSV_DECIMAL.match(term):
+        datatype = "decimal"
+    else:
+        datatype = "double"
+
+    return {"type": "literal", "value": term, "datatype": f"{XSD}{datatype}"}
+
+
+class SPARQLQueryError(Exception):
+    """Raised when the SPARQL endpoint returns an error response"""
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(f"SPARQL endpoint returned {status}: {message}")
+
+        self.status = status
+        self.message = message
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no pooled connection becomes available in time"""
+
+
+class QueryTimeoutError(Exception):
+    """Raised when a query is given no time left to run, or when its
+    response does not arrive in time"""
+
+
+# Errors raised when a query does not complete within its timeout
+QUERY_TIMEOUT_ERRORS = (
+    socket.timeout,
+    PoolTimeoutError,
+    QueryTimeoutError
+)
+
+
+class DigestAuth():
+    """Digest authentication state for a single connection.
+
+    The challenge is negotiated once when the server first replies
+    with a 401 and then reused for all the following requests on the
+    same connection, incrementing the nonce count each time.
+    """
+    def __init__(self, username: str, password: str) -> None:
+        self.username = username
+        self.password = password
+        self.challenge = None
+        self.nonce_count = 0
+
+    def negotiate(self, header: str) -> bool:
+        """Stores the digest challenge in a WWW-Authenticate header.
+        Returns whether the header contained a digest challenge"""
+        scheme, _, params = header.partition(" ")
+
+        if scheme.lower() != "digest":
+            return False
+
+        challenge = parse_keqv_list(parse_http_list(params))
+        challenge["algorithm"] = challenge.get("algorithm", "MD5").upper()
+
+        if challenge["algorithm"] not in DIGEST_ALGORITHMS:
+            return False
+
+        self.challenge = challenge
+        self.nonce_count = 0
+
+        return True
+
+    def authorization(self, method: str, uri: str):
+        """Returns the Authorization header for a request or None
+        if no challenge was negotiated yet"""
+        if self.challenge is None:
+            return None
+
+        challenge = self.challenge
+        algorithm = challenge["algorithm"]
+        hash_fn = DIGEST_ALGORITHMS[algorithm]
+
+        def digest(*parts):
+            return hash_fn(":".join(parts).encode("utf-8")).hexdigest()
+
+        self.nonce_count += 1
+
+        nonce = challenge["nonce"]
+        nc = f"{self.nonce_count:08x}"
+        cnonce = os.urandom(8).hex()
+
+        ha1 = digest(self.username, challenge["realm"], self.password)
+        ha2 = digest(method, uri)
+
+        if algorithm.endswith("-SESS"):
+            ha1 = digest(ha1, nonce, cnonce)
+
+        qop_options = [q.strip() for q in challenge.get("qop", "").split(",")]
+
+        fields = [
+            f'username="{self.username}"',
+            f'realm="{challenge["realm"]}"',
+            f'nonce="{nonce}"',
+            f'uri="{uri}"',
+            f'algorithm={algorithm}'
+        ]
+
+        if "auth" in qop_options:
+            response = digest(ha1, nonce, nc, cnonce, "auth", ha2)
+            fields.extend(["qop=auth", f"nc={nc}", f'cnonce="{cnonce}"'])
+        else:
+            response = digest(ha1, nonce, ha2)
+
+        fields.append(f'response="{response}"')
+
+        if "opaque" in challenge:
+            fields.append(f'opaque="{challenge["opaque"]}"')
+
+        return "Digest " + ", ".join(fields)
+
+
+class PooledConnection():
+    """An HTTP connection to the endpoint and its authentication state"""
+    def __init__(self, connection: http.client.HTTPConnection, auth) -> None:
+        self.connection = connection
+        self.auth = auth
+        self.aborted = False
+
+    def set_timeout(self, timeout: float):
+        """Sets the socket timeout of the following requests"""
+        self.connection.timeout = timeout
+
+        if self.connection.sock is not None:
+            self.connection.sock.settimeout(timeout)
+
+    def close(self):
+        self.connection.close()
+
+    def abort(self):
+        """Shuts down the socket from another thread, so that a request
+        blocked reading the response fails"""
+        self.aborted = True
+        sock = self.connection.sock
+
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class SPARQLClient():
+    """SPARQL protocol client safe to share between threads and greenlets.
+
+    Every call to `query` is an independent request, so there is no
+    shared mutable query state. Connections are kept alive and reused
+    through a pool holding at most `pool_size` connections; callers
+    wait up to `pool_timeout` seconds for a free connection. The
+    `timeout` parameter is the socket timeout of each request. Both
+    can be lowered per call with the `timeout` parameter of `query`,
+    e.g. to fit a request deadline.
+    """
+    def __init__(
+            self,
+            endpoint_url: str,
+            username: str = None,
+            password: str = None,
+            parameters: dict = None,
+            pool_size: int = 8,
+            timeout: float = 30.0,
+            pool_timeout: float = 30.0) -> None:
+        url = urlsplit(endpoint_url)
+
+        self.scheme = url.scheme
+        self.host = url.hostname
+        self.port = url.port
+        self.path = url.path or "/"
+
+        if url.query:
+            self.path = f"{self.path}?{url.query}"
+
+        self.username = username
+        self.password = password
+        self.parameters = parameters or {}
+        self.timeout = timeout
+        self.pool_timeout = pool_timeout
+
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._idle = []
+        self._idle_lock = threading.Lock()
+
+    def query(self, query: str, timeout: float = None) -> dict:
+        """Runs a SELECT query and returns the parsed JSON results"""
+        with self._stream(query, accept="application/sparql-results+json", timeout=timeout) as response:
+            return json.load(response)
+
+    def iter_bindings(self, query: str, page_size: int = None, key: str = None):
+        """Runs a SELECT query and yields its result bindings, in the
+        same format as the JSON results, without loading the whole
+        result in memory.
+
+        Results are requested as TSV and parsed line by line. If
+        page_size is given, the query is executed in pages of at most
+        page_size results with keyset pagination on the `key` variable:
+        the query must be ordered by STR(?key) first and contain
+        KEYSET_FILTER in its WHERE clause, which is replaced by a filter
+        selecting the keys after the previous page. Unlike LIMIT/OFFSET,
+        the endpoint never skips over the results of the previous pages.
+
+        The results of a key are never split across pages, so a key
+        with page_size results or more is fetched by a query of its own.
+        """
+        if page_size is None:
+            yield from self._iter_tsv_bindings(query)
+            return
+
+        if KEYSET_FILTER not in query:
+            raise ValueError("Paginated queries must contain KEYSET_FILTER")
+
+        after = None
+
+        while True:
+            condition = None if after is None else f"STR(?{key}) > {sparql_string(after)}"
+            page_results = 0
+
+            # Results of the last key of the page, which may continue
+            # on the next page
+            last_key, held = None, []
+
+            for binding in self._iter_tsv_bindings(keyset_query(query, condition, page_size)):
+                page_results += 1
+
+                if binding[key]["value"] != last_key:
+                    yield from held
+
+                    if held:
+                        after = last_key
+
+                    last_key, held = binding[key]["value"], []
+
+                held.append(binding)
+
+            if page_results < page_size:
+                yield from held
+                return
+
+            if len(held) == page_results:
+                # The whole page has a single key
+                condition = f"STR(?{key}) = {sparql_string(last_key)}"
+
+                yield from self._iter_tsv_bindings(keyset_query(query, condition))
+
+                after = last_key
+
+    def close(self):
+        """Closes all the idle connections, when the process exits"""
+        with self._idle_lock:
+            idle, self._idle = self._idle, []
+
+        for conn in idle:
+            conn.close()
+
+    def _iter_tsv_bindings(self, query: str):
+        with self._stream(query, accept="text/tab-separated-values") as response:
+            header = response.readline().decode("utf-8").rstrip("\r\n")
+
+            # Strip the ? or $ in front of the variable names
+            variables = [var[1:] for var in header.split("\t")]
+
+            for line in response:
+                line = line.decode("utf-8").rstrip("\r\n")
+
+                if not line:
+                    continue
+
+                yield {
+                    var: parse_tsv_term(term)
+                    for var, term in zip(variables, line.split("\t"))
+                    # Unbound variables are empty
+                    if term
+                }
+
+    @contextmanager
+    def _stream(self, query: str, accept: str, timeout: float = None):
+        """Runs a query on a pooled connection and yields the HTTP
+        response before its body is read. The connection is closed
+        if the caller stops before the end of the body.
+
+        If timeout is given it replaces the client timeouts, when lower.
+        Connections are closed on timeout, which lets the endpoint
+        abandon the query. Socket timeouts apply to each read, so a
+        slowly arriving response could outlive the given timeout: the
+        connection is then shut down by a timer, and QueryTimeoutError
+        raised."""
+        if timeout is not None and timeout <= 0:
+            raise QueryTimeoutError("No time left to run the SPARQL query")
+
+        payload = urlencode({
+            "query": query,
+            **self.parameters
+        })
+
+        conn = self._acquire(self._lower_timeout(self.pool_timeout, timeout))
+        conn.aborted = False
+        reusable = False
+        watchdog = None
+
+        try:
+            conn.set_timeout(self._lower_timeout(self.timeout, timeout))
+
+            if timeout is not None:
+                watchdog = threading.Timer(timeout, conn.abort)
+                watchdog.daemon = True
+                watchdog.start()
+
+            response = self._open(conn, payload, accept)
+
+            if response.status >= 400:
+                body = response.read()
+                reusable = not response.will_close
+
+                raise SPARQLQueryError(response.status, body.decode("utf-8", "replace"))
+
+            yield response
+
+            # Reading lines does not consume the end of the body, drain
+            # it so that the response is complete
+            response.read()
+            reusable = not response.will_close
+        except (OSError, http.client.HTTPException) as error:
+            if conn.aborted:
+                raise QueryTimeoutError(f"SPARQL query aborted after {timeout}s") from error
+
+            raise
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+
+            if not reusable or conn.aborted:
+                # The connection reconnects on its next request
+                conn.close()
+
+            self._release(conn)
+
+    def _lower_timeout(self, default: float, timeout: float = None) -> float:
+        return default if timeout is None else min(default, timeout)
+
+    def _open(self, conn: PooledConnection, payload: str, accept: str):
+        """Sends a query on a pooled connection, negotiating digest
+        authentication if the server requests it"""
+        for attempt in range(2):
+            try:
+                response = self._post(conn, payload, accept)
+            except STALE_CONNECTION_ERRORS:
+                if attempt > 0:
+                    raise
+
+                # The server closed the idle connection, reconnect
+                conn.close()
+                continue
+
+            if response.status == 401 and conn.auth is not None:
+                challenge = response.getheader("WWW-Authenticate", "")
+
+                if conn.auth.negotiate(challenge):
+                    response = self._post(conn, payload, accept)
+
+            return response
+
+    def _post(self, conn: PooledConnection, payload: str, accept: str):
+        headers = {
+            "Accept": accept,
+            "Content-Type": "application/x-www-form-urlencoded; charset=UTF-8"
+        }
+
+        if conn.auth is not None:
+            authorization = conn.auth.authorization("POST", self.path)
+
+            if authorization is not None:
+                headers["Authorization"] = authorization
+
+        conn.connection.request(
+            "POST",
+            self.path,
+            body=payload.encode("utf-8"),
+            headers=headers
+        )
+
+        response = conn.connection.getresponse()
+
+        if response.status == 401:
+            # Drain the body so the connection can be reused
+            response.read()
+
+        return response
+
+    def _acquire(self, timeout: float) -> PooledConnection:
+        if not self._slots.acquire(timeout=timeout):
+            raise PoolTimeoutError(
+                f"No SPARQL connection available after {timeout}s"
+            )
+
+        with self._idle_lock:
+            if self._idle:
+                return self._idle.pop()
+
+        return self._new_connection()
+
+    def _release(self, conn: PooledConnection):
+        with self._idle_lock:
+            self._idle.append(conn)
+
+        self._slots.release()
+
+    def _new_connection(self) -> PooledConnection:
+        if self.scheme == "https":
+            connection = http.client.HTTPSConnection(
+                self.host, self.port, timeout=self.timeout
+            )
+        else:
+            connection = http.client.HTTPConnection(
+                self.host, self.port, timeout=self.timeout
+            )
+
+        return PooledConnection(connection, self._new_auth())
+
+    def _new_auth(self):
+        if self.username is None:
+            return None
+
+        return DigestAuth(self.username, self.password)
@@ -4,45 +4,168 @@
 import os
 import json
 
-from SPARQLWrapper import (
-    JSON,
-    DIGEST,
-    SPARQLWrapper
+from itertools import combinations
+from concurrent.futures import (
+    as_completed,
+    ThreadPoolExecutor,
+    TimeoutError as FuturesTimeoutError
 )
 
+from api.helpers import AdaptiveChunkSize, Deadline
+from api.helpers.cache import (
+    cache_key,
+    LabelCache,
+    ResultCache
+)
+from api.helpers.sparql.client import (
+    KEYSET_FILTER,
+    QUERY_TIMEOUT_ERRORS,
+    SPARQLClient
+)
+from api.helpers.sparql.adjacency import (
+    AdjacencyIndex,
+    AdjacencyIndexUnavailable,
+    BackgroundAdjacencyIndex
+)
 from api.helpers.sparql.structs import (
+    QueryBatching,
     QueryCyclesStrategy,
+    RelationshipEngine,
+    RelationshipDirection,
     RelationshipQueryConfig
 )
 
-from api.helpers.sparql.relationships import get_queries
+from api.helpers.sparql.graph import (
+    add_path_collections,
+    rank_path_collections,
+    RelationshipGraph
+)
+from api.helpers.sparql.relationships import (
+    arm_query,
+    join_arms,
+    get_distance_queries,
+    union_query,
+    get_direct_queries,
+    middle_object_layout
+)
+
+
+IGNORED_PROPERTIES = [
+    "http://www.w3.org/1999/02/22-rdf-syntax-ns#type",
+    "http://www.w3.org/2004/02/skos/core#subject"
+]
+
+# Version of the cached path blocks, increased when their format changes
+PATH_BLOCK_VERSION = 3
 
 
 class SPARQLEndpoint():
     def __init__(
             self,
             allowed_object_properties: list,
-            allowed_entity_classes: list) -> None:
+            allowed_entity_classes: list,
+            max_concurrent_queries: int = 8,
+            connection_pool_size: int = 8,
+            query_timeout: float = 30.0,
+            cache: ResultCache = None,
+            label_cache: LabelCache = None,
+            relationship_engine: RelationshipEngine = RelationshipEngine.SPARQL,
+            adjacency_index_ttl: float = 86400,
+            adjacency_index_path: str = None,
+            query_batching: QueryBatching = QueryBatching.NONE,
+            combined_label_queries: bool = False,
+            label_chunk_size: AdaptiveChunkSize = None,
+            result_page_size: int = 10000,
+            query_time_budget: float = None,
+            label_time_reserve: float = 0.0,
+            query_result_limit: int = None,
+            max_paths: int = 2000) -> None:
         self.allowed_object_properties = allowed_object_properties
+        self.allowed_properties = frozenset(allowed_object_properties)
         self.allowed_entity_classes = [
             f"<{iri}>" for iri in allowed_entity_classes
         ]
 
-        self.sparql = SPARQLWrapper(
-            os.environ["SPARQL_ENDPOINT"]
+        # Each relationship query returns at most query_result_limit
+        # results, and searches return the max_paths best paths
+        self.query_result_limit = query_result_limit
+        self.max_paths = max_paths
+
+        # Optional caches for relationship results and for the labels
+        # and types of IRIs. The configuration digest invalidates cached
+        # relationships when the allowed or ignored properties or the
+        # result limit change
+        self.cache = cache
+        self.label_cache = label_cache
+        self.config_digest = cache_key(
+            "config",
+            sorted(allowed_object_properties),
+            sorted(IGNORED_PROPERTIES),
+            query_result_limit
         )
 
-        self.sparql.setHTTPAuth(DIGEST)
-        self.sparql.setCredentials(
-            os.environ["SPARQL_USERNAME"],
-            os.environ["SPARQL_PASSWORD"]
+        # The client is shared by all requests and keeps a pool of
+        # authenticated keep-alive connections to the endpoint
+        self.client = SPARQLClient(
+            os.environ["SPARQL_ENDPOINT"],
+            username=os.environ["SPARQL_USERNAME"],
+            password=os.environ["SPARQL_PASSWORD"],
+            # Use reasoning
+            parameters={"reasoning": "false"},
+            pool_size=connection_pool_size,
+            timeout=query_timeout,
+            pool_timeout=query_timeout
         )
 
-        # Use reasoning
-        self.sparql.addParameter("reasoning", "false")
-        self.sparql.setReturnFormat(JSON)
+        # Large results (entities, adjacency triples) are streamed in
+        # pages of at most result_page_size results
+        self.result_page_size = result_page_size
+
+        # Time budget in seconds of the SPARQL work of a request, see
+        # `new_deadline`. None disables request deadlines. The last
+        # label_time_reserve seconds are kept for the label lookups
+        self.query_time_budget = query_time_budget
+        self.label_time_reserve = label_time_reserve
+
+        # The adjacency index is built in the background, once started
+        # with `self.adjacency.start()`, and rebuilt every
+        # adjacency_index_ttl seconds
+        self.relationship_engine = relationship_engine
+        self.adjacency = BackgroundAdjacencyIndex(
+            self.object_property_triples,
+            refresh_interval=adjacency_index_ttl,
+            path=adjacency_index_path
+        )
+
+        # Relationship queries are independent of each other, so they
+        # are executed on a bounded pool shared by all requests. Under
+        # the gunicorn gevent workers the pool threads are greenlets
+        self.max_concurrent_queries = max_concurrent_queries
+        self.query_batching = query_batching
+        self.combined_label_queries = combined_label_queries
+        self.label_chunk_size = label_chunk_size or AdaptiveChunkSize()
+        self.executor = None
+
+        if max_concurrent_queries > 1:
+            self.executor = ThreadPoolExecutor(
+                max_workers=max_concurrent_queries,
+                thread_name_prefix="sparql-query"
+            )
+
+    def new_deadline(self):
+        """Returns the deadline of a new request or None if requests
+        have no time budget"""
+        if self.query_time_budget is None:
+            return None
+
+        return Deadline(self.query_time_budget, reserved=self.label_time_reserve)
 
     def entities(self) -> list:
+        return list(self.iter_entities())
+
+    def iter_entities(self):
+        """Yields the entities of the allowed classes, fetching them in
+        pages of result_page_size results"""
         # FIXME: Load allowed classes from a config file?
         allowed_classes = ", ".join(self.allowed_entity_classes)
 
@@ -51,33 +174,54 @@ class SPARQLEndpoint():
                 ?s a ?ctype ;
                 rdfs:label | <http://w3id.org/um/cbcm/eu-cm-ontology#name> ?label .
                 FILTER (?ctype IN ({allowed_classes}))
+                {KEYSET_FILTER}
             }}
+            ORDER BY STR(?s) ?ctype ?label
         """
 
-        self.sparql.setQuery(query)
-
-        results = self.sparql.query().convert()
-        results = results["results"]["bindings"]
-        results = [{
-            "iri": item["s"]["value"],
-            "label": item["label"]["value"],
-            "class": item["ctype"]["value"]
-        } for item in results]
+        for item in self.client.iter_bindings(query, page_size=self.result_page_size, key="s"):
+            yield {
+                "iri": item["s"]["value"],
+                "label": item["label"]["value"],
+                "class": item["ctype"]["value"]
+            }
 
-        return results
+    def entity_counts_by_class(self) -> dict:
+        """Returns the number of entities of each allowed class"""
+        allowed_classes = " ".join(self.allowed_entity_classes)
 
-    def entity_count_for_class(self, class_iri: str) -> int:
         query = f"""
-            SELECT (count(distinct ?ent) AS ?entities)
-            WHERE {{ ?ent a <{class_iri}> . }}
+            SELECT ?class (count(distinct ?ent) AS ?entities) WHERE {{
+                VALUES ?class {{ {allowed_classes} }}
+                ?ent a ?class .
+            }}
+            GROUP BY ?class
         """
 
-        self.sparql.setQuery(query)
+        # Classes without entities have no result row
+        counts = {iri[1:-1]: 0 for iri in self.allowed_entity_classes}
 
-        results = self.sparql.query().convert()
-        entities_count = results["results"]["bindings"][0]["entities"]["value"]
+        for item in self._query_bindings(query):
+            counts[item["class"]["value"]] = int(item["entities"]["value"])
 
-        return int(entities_count)
+        return counts
+
+    def allowed_entity_count(self) -> int:
+        """Returns the number of distinct entities of the allowed classes.
+        Entities of several classes, such as global ultimate owners that
+        are also companies, are counted once"""
+        allowed_classes = " ".join(self.allowed_entity_classes)
+
+        query = f"""
+            SELECT (count(distinct ?ent) AS ?entities) WHERE {{
+                VALUES ?class {{ {allowed_classes} }}
+                ?ent a ?class .
+            }}
+        """
+
+        results = self._query_bindings(query)
+
+        return int(results[0]["entities"]["value"])
 
     def entity_data_properties(self, entity_iri: str, limit: int = 50) -> list:
         query = f"""
@@ -88,10 +232,7 @@ class SPARQLEndpoint():
             }} LIMIT {limit}
         """
 
-        self.sparql.setQuery(query)
-
-        results = self.sparql.query().convert()
-        results = results["results"]["bindings"]
+        results = self._query_bindings(query)
         results = [{
             "iri": item["p"]["value"],
             "label": item["propLabel"]["value"],
@@ -103,24 +244,18 @@ class SPARQLEndpoint():
 
         return list(unique_results)
 
-    def label_for_entities(self, entityIRIs: list):
-        entityIRIs = [
-            f"{{ ?p rdfs:label | <http://w3id.org/um/cbcm/eu-cm-ontology#name> ?label FILTER(?p = <{iri}>)}}"
-            for iri in entityIRIs
-        ]
-
-        entitySubqueries = " UNION\n\t\t".join(entityIRIs)
+    def label_for_entities(self, entityIRIs: list, timeout: float = None):
+        values = " ".join([f"<{iri}>" for iri in entityIRIs])
 
         query = f"""
-            SELECT * WHERE {{
-                {entitySubqueries}
+            SELECT ?p ?label WHERE {{
+                VALUES ?p {{ {values} }}
+                ?p rdfs:label | <http://w3id.org/um/cbcm/eu-cm-ontology#name> ?label .
                 FILTER (lang(?label) = 'en' || lang(?label) = '')
             }}
         """
 
-        self.sparql.setQuery(query)
-
-        results = self.sparql.query().convert()["results"]["bindings"]
+        results = self._query_bindings(query, timeout=timeout)
 
         # Create a dictionary mapping IRIs to rdfs:label values
         labels_map = {}
@@ -130,22 +265,18 @@ class SPARQLEndpoint():
 
         return labels_map
 
-    def type_for_entities(self, entity_iris: list, ontology_prefix: str):
-        entity_iris = [
-            f"{{ ?o rdf:type ?type FILTER(?o = <{iri}> && !isBlank(?type))}}"
-            for iri in entity_iris
-        ]
-
-        entity_iris = " UNION\n\t\t".join(entity_iris)
+    def type_for_entities(self, entity_iris: list, ontology_prefix: str, timeout: float = None):
+        values = " ".join([f"<{iri}>" for iri in entity_iris])
 
         query = f"""
-            SELECT * WHERE {{
-                {entity_iris}
+            SELECT ?o ?type WHERE {{
+                VALUES ?o {{ {values} }}
+                ?o rdf:type ?type .
+                FILTER (!isBlank(?type))
             }}
         """
 
-        self.sparql.setQuery(query)
-        results = self.sparql.query().convert()["results"]["bindings"]
+        results = self._query_bindings(query, timeout=timeout)
 
         # Create a dictionary mapping IRIs to rdf:type values
         type_map = {}
@@ -164,273 +295,675 @@ class SPARQLEndpoint():
 
         return type_map
 
-    def find_relationships(self, entity1: str, entity2: str, max_distance: int):
-        """Returns a dictionary representing the direct and
-        deep links between entity1 and entity2
+    def object_property_triples(self):
+        """Yields all the (subject, property, object) triples whose
+        property is an allowed object property"""
+        allowed_properties = " ".join([
+            f"<{iri}>" for iri in self.allowed_object_properties
+        ])
+
+        query = f"""
+            SELECT ?s ?p ?o WHERE {{
+                VALUES ?p {{ {allowed_properties} }}
+                ?s ?p ?o .
+                FILTER (isIRI(?o))
+                {KEYSET_FILTER}
+            }}
+            ORDER BY STR(?s) ?p ?o
+        """
+
+        for item in self.client.iter_bindings(query, page_size=self.result_page_size, key="s"):
+            yield item["s"]["value"], item["p"]["value"], item["o"]["value"]
+
+    def adjacency_index(self) -> AdjacencyIndex:
+        """Returns the adjacency index of the object-property subgraph.
+        Raises AdjacencyIndexUnavailable if it is not loaded yet"""
+        index = self.adjacency.index
+
+        if index is None:
+            raise AdjacencyIndexUnavailable("The adjacency index is loading, retry later")
+
+        return index
+
+    def check_engine(self, engine: RelationshipEngine = None):
+        """Raises AdjacencyIndexUnavailable if engine, or the configured
+        engine if None, is the index engine and the index is not loaded.
+        Lets streaming routes fail before the response is started"""
+        if (engine or self.relationship_engine) == RelationshipEngine.INDEX:
+            self.adjacency_index()
+
+    def label_and_type_for_entities(self, entity_iris: list, ontology_prefix: str, timeout: float = None):
+        """Returns the label and type maps of a list of entities,
+        fetched with a single query"""
+        values = " ".join([f"<{iri}>" for iri in entity_iris])
+
+        query = f"""
+            SELECT ?p ?label ?type WHERE {{
+                VALUES ?p {{ {values} }}
+                OPTIONAL {{
+                    ?p rdfs:label | <http://w3id.org/um/cbcm/eu-cm-ontology#name> ?label
+                    FILTER (lang(?label) = 'en' || lang(?label) = '')
+                }}
+                OPTIONAL {{
+                    ?p rdf:type ?type
+                    FILTER (!isBlank(?type))
+                }}
+            }}
+        """
+
+        results = self._query_bindings(query, timeout=timeout)
+        labels_map, type_map = {}, {}
+
+        # As in type_for_entities, the last class of an entity
+        # is the most specific one
+        for res in results:
+            if "label" in res:
+                labels_map[res["p"]["value"]] = res["label"]["value"]
+
+            if "type" in res and res["type"]["value"].startswith(ontology_prefix):
+                type_map[res["p"]["value"]] = res["type"]["value"]
+
+        return labels_map, type_map
+
+    def find_relationships(
+            self,
+            entity1: str,
+            entity2: str,
+            max_distance: int,
+            engine: RelationshipEngine = None,
+            deadline: Deadline = None):
+        """Returns the relationship graph of the direct and deep
+        links between entity1 and entity2 and the raw query results
+
+        The `engine` parameter overrides the configured relationship
+        engine. The index engine returns no raw SPARQL response.
+
+        At most `max_paths` paths are returned, see `_rank_paths`. The
+        graph is marked as truncated if paths were left out, either by
+        `max_paths` or by a query returning `query_result_limit` results.
+
+        If a `deadline` is given, the queries still running when it
+        expires are cancelled and the graph only contains the paths
+        found so far. `deadline.expired` is then set. The index engine
+        stops its search in the same way.
+        """
+        if (engine or self.relationship_engine) == RelationshipEngine.INDEX:
+            output_paths = self._rank_paths(self._index_path_collections(
+                entity1,
+                entity2,
+                max_distance,
+                deadline=deadline
+            ))
+
+            return self._build_relationships_graph(entity1, entity2, output_paths), None
+
+        output_paths = self._rank_paths(self._pairs_path_collections(
+            [(entity1, entity2)],
+            max_distance,
+            deadline=deadline
+        )[0])
+
+        return self._build_relationships_graph(
+            entity1,
+            entity2,
+            output_paths), output_paths
+
+    def stream_relationships(
+            self,
+            entity1: str,
+            entity2: str,
+            max_distance: int,
+            engine: RelationshipEngine = None,
+            graph: RelationshipGraph = None,
+            deadline: Deadline = None):
+        """Builds the relationship graph between entity1 and entity2
+        incrementally and yields (distance, nodes, edges) tuples, where
+        nodes and edges are the serialized ones added since the previous
+        tuple. The complete graph is accumulated in `graph`, if given.
+
+        A tuple is yielded as soon as each relationship query completes,
+        so the shortest paths are usually available long before the
+        deepest queries finish. The index engine yields the whole
+        graph at once. See `find_relationships` for `deadline`.
+
+        Paths are added in order of completion rather than ranked. The
+        remaining queries are cancelled once `max_paths` paths are added,
+        and the graph is then marked as truncated.
+        """
+        if graph is None:
+            graph = RelationshipGraph()
+
+        for endpoint in (entity1, entity2):
+            graph.add_node(endpoint, endpoint=True)
+
+        if (engine or self.relationship_engine) == RelationshipEngine.INDEX:
+            add_path_collections(
+                graph,
+                self._rank_paths(self._index_path_collections(
+                    entity1,
+                    entity2,
+                    max_distance,
+                    deadline=deadline
+                )),
+                self.allowed_properties
+            )
+
+            yield max_distance, graph.serialize_nodes(), graph.serialize_edges()
+            return
+
+        node_count, edge_count = 0, 0
+        remaining_paths = self.max_paths
+
+        for distance, _, collection in self.iter_relationship_paths(
+                entity1,
+                entity2,
+                max_distance,
+                deadline=deadline):
+            collections = self._rank_paths([collection], max_paths=remaining_paths)
+            remaining_paths -= len(collections[0]["paths"])
+
+            add_path_collections(graph, collections, self.allowed_properties)
+
+            if len(graph) > node_count or graph.edge_count > edge_count:
+                yield (
+                    distance,
+                    graph.serialize_nodes(node_count),
+                    graph.serialize_edges(edge_count)
+                )
+
+                node_count, edge_count = len(graph), graph.edge_count
+
+            if remaining_paths <= 0:
+                # The paths of the queries left may be missing
+                graph.truncated = True
+                return
+
+    def find_relationships_batch(
+            self,
+            pairs: list,
+            max_distance: int,
+            engine: RelationshipEngine = None,
+            graph: RelationshipGraph = None,
+            deadline: Deadline = None) -> list:
+        """Returns the relationship graph of each (entity1, entity2) pair.
+
+        The queries of all the pairs are executed together on the query
+        executor. If `graph` is given the relationships of all the pairs
+        are added to it and it is returned for every pair. See
+        `find_relationships` for `deadline`. The `max_paths` limit
+        applies to each pair.
+        """
+        if graph is None:
+            graphs = [RelationshipGraph() for _ in pairs]
+        else:
+            graphs = [graph] * len(pairs)
+
+        for pair_graph, (entity1, entity2) in zip(graphs, pairs):
+            pair_graph.add_node(entity1, endpoint=True)
+            pair_graph.add_node(entity2, endpoint=True)
+
+        if (engine or self.relationship_engine) == RelationshipEngine.INDEX:
+            pairs_collections = [
+                self._index_path_collections(entity1, entity2, max_distance, deadline=deadline)
+                for entity1, entity2 in pairs
+            ]
+        else:
+            pairs_collections = self._pairs_path_collections(pairs, max_distance, deadline=deadline)
+
+        for pair_graph, path_collections in zip(graphs, pairs_collections):
+            add_path_collections(
+                pair_graph,
+                self._rank_paths(path_collections),
+                self.allowed_properties
+            )
+
+        return graphs
+
+    def find_relationships_multi(
+            self,
+            entities: list,
+            max_distance: int,
+            engine: RelationshipEngine = None,
+            graph: RelationshipGraph = None,
+            deadline: Deadline = None):
+        """Returns a single relationship graph between all the pairs of
+        entities, and the path collections it was built from.
+
+        Direct connections are queried for each pair, while the one-sided
+        arms of the middle object queries are queried once per entity
+        and joined client-side for each pair, so the number of queries
+        grows with the number of entities rather than with the number
+        of pairs. Results are not cached. See `find_relationships` for
+        `deadline`. The `max_paths` limit applies to the whole graph.
+        """
+        if graph is None:
+            graph = RelationshipGraph()
+
+        for entity in entities:
+            graph.add_node(entity, endpoint=True)
+
+        pairs = list(combinations(entities, 2))
+
+        if (engine or self.relationship_engine) == RelationshipEngine.INDEX:
+            path_collections = []
+
+            for entity1, entity2 in pairs:
+                path_collections.extend(self._index_path_collections(
+                    entity1,
+                    entity2,
+                    max_distance,
+                    ignored_objects=[e for e in entities if e not in (entity1, entity2)],
+                    deadline=deadline
+                ))
+
+            add_path_collections(graph, self._rank_paths(path_collections), self.allowed_properties)
+
+            return graph, None
+
+        directions = (RelationshipDirection.FORWARD, RelationshipDirection.BACKWARD)
+        jobs = []
+
+        for pair_idx, (entity1, entity2) in enumerate(pairs):
+            # As in the arms, paths between two entities do not go
+            # through the other ones, since those paths are already
+            # made of the paths of the other pairs
+            query_config = self._relationship_query_config(
+                entity1,
+                entity2,
+                max_distance,
+                ignored_objects=[e for e in entities if e not in (entity1, entity2)]
+            )
+
+            for distance, block in get_direct_queries(query_config).items():
+                jobs.extend([
+                    (("direct", pair_idx, distance), idx, query)
+                    for idx, query in enumerate(block)
+                ])
+
+        # As the direct queries, the arms of an entity and distance are
+        # a block with one query per direction
+        for entity in entities:
+            for distance in range(1, max_distance):
+                for idx, direction in enumerate(directions):
+                    jobs.append((("arm", entity, distance), idx, {
+                        "query": arm_query(
+                            entity,
+                            distance,
+                            direction,
+                            self._relationship_query_config(entity, entity, distance),
+                            entities
+                        )
+                    }))
+
+        # Direct queries and arms of shorter distances first, as in
+        # iter_pairs_relationship_paths
+        jobs.sort(key=lambda job: job[0][2])
+
+        results = {}
+
+        for (key, idx, query), paths in self._iter_completed_queries(jobs, deadline=deadline):
+            results[(key, idx)] = (query, paths)
+
+        # The results of the queries cancelled by the deadline are missing
+        path_collections = []
+
+        for pair_idx, (entity1, entity2) in enumerate(pairs):
+            for distance in range(1, max_distance + 1):
+                for idx in range(len(directions)):
+                    if (("direct", pair_idx, distance), idx) not in results:
+                        continue
+
+                    query, paths = results[(("direct", pair_idx, distance), idx)]
+
+                    path_collections.append(self._path_collection(query, paths))
+
+                # Same order as the middle object queries of get_queries
+                for a in range(1, distance):
+                    for idx in range(len(directions)):
+                        first_key = (("arm", entity1, a), idx)
+                        second_key = (("arm", entity2, distance - a), idx)
+
+                        if first_key not in results or second_key not in results:
+                            continue
+
+                        _, first = results[first_key]
+                        _, second = results[second_key]
+
+                        # Joined paths are missing if either arm is truncated
+                        path_collections.append({
+                            "src": entity1,
+                            "dest": entity2,
+                            "layout": middle_object_layout(a, distance - a),
+                            "paths": join_arms(first, second),
+                            "truncated": self._limit_reached(first) or self._limit_reached(second)
+                        })
+
+        path_collections = self._rank_paths(path_collections)
+
+        add_path_collections(graph, path_collections, self.allowed_properties)
+
+        return graph, path_collections
+
+    def _pairs_path_collections(self, pairs: list, max_distance: int, deadline: Deadline = None) -> list:
+        """Returns the path collections of the relationship queries of
+        each (entity1, entity2) pair, ordered by distance"""
+        path_blocks = [{} for _ in pairs]
+
+        for pair_idx, distance, idx, collection in self.iter_pairs_relationship_paths(
+                pairs,
+                max_distance,
+                deadline=deadline):
+            path_blocks[pair_idx][(distance, idx)] = collection
+
+        return [
+            [blocks[key] for key in sorted(blocks.keys())]
+            for blocks in path_blocks
+        ]
+
+    def iter_relationship_paths(
+            self,
+            entity1: str,
+            entity2: str,
+            max_distance: int,
+            deadline: Deadline = None):
+        """Yields a (distance, query index, path collection) tuple for
+        each relationship query between entity1 and entity2, in order
+        of completion.
+
+        Each distance block is cached independently, so widening a
+        search only runs the queries of the new distances. Cached blocks
+        are yielded first, then the queries of all the missing blocks
+        are executed together.
+
+        If a `deadline` is given the queries are cancelled once it
+        expires, and `deadline.expired` is set. Blocks with cancelled
+        queries are not cached.
+        """
+        for _, distance, idx, collection in self.iter_pairs_relationship_paths(
+                [(entity1, entity2)],
+                max_distance,
+                deadline=deadline):
+            yield distance, idx, collection
+
+    def iter_pairs_relationship_paths(self, pairs: list, max_distance: int, deadline: Deadline = None):
+        """Yields a (pair index, distance, query index, path collection)
+        tuple for each relationship query of a list of (entity1, entity2)
+        pairs, in order of completion.
+
+        The queries of all the pairs share the query executor, so they
+        are scheduled with the same concurrency budget as the ones of a
+        single pair. See `iter_relationship_paths` for caching and
+        deadlines.
         """
-        ignored_properties = [
-            "http://www.w3.org/1999/02/22-rdf-syntax-ns#type",
-            "http://www.w3.org/2004/02/skos/core#subject"
+        query_configs = [
+            self._relationship_query_config(entity1, entity2, max_distance)
+            for entity1, entity2 in pairs
         ]
 
-        query_config = RelationshipQueryConfig(
-            entity1IRI=entity1,
-            entity2IRI=entity2,
-            ignored_objects=[],
-            ignored_properties=ignored_properties,
-            avoid_cycles=QueryCyclesStrategy.NO_INTERMEDIATE_DUPLICATES,
-            max_distance=max_distance
+        # Blocks are built one pair and distance at a time, shorter
+        # distances first, so that the queries of the blocks there is
+        # no time left to run are never built. Missing blocks are then
+        # scheduled in the same order
+        block_keys = (
+            (pair_idx, distance)
+            for distance in range(1, max_distance + 1)
+            for pair_idx in range(len(pairs))
         )
 
-        query_blocks = get_queries(query_config=query_config)
-        queries, output_paths = [], []
+        missing_blocks = {}
 
-        for _, block in query_blocks.items():
-            queries.extend(block)
+        for block_key in block_keys:
+            if deadline is not None and deadline.remaining() <= 0:
+                deadline.expired = True
+                break
+
+            cached_block = None
 
-        for query in queries:
-            self.sparql.setQuery(query["query"])
+            if self.cache is not None:
+                cached_block = self.cache.get(self._block_cache_key(pairs, block_key))
 
-            results = self.sparql.query().convert()
+            if cached_block is None:
+                pair_idx, distance = block_key
+                missing_blocks[block_key] = get_distance_queries(query_configs[pair_idx], distance)
+                continue
 
-            output_paths.append({
-                "src": query["src"],
-                "dest": query["dest"],
-                "paths": results['results']['bindings']
-            })
+            for idx, collection in enumerate(cached_block):
+                yield (*block_key, idx, collection)
+
+        jobs = [
+            (block_key, idx, query)
+            for block_key, block in missing_blocks.items()
+            for idx, query in enumerate(block)
+        ]
 
         if os.environ.get("DEBUG", False):
             with open("debug/queries.json", "w") as queries_file:
-                queries_file.write(json.dumps(queries))
+                queries_file.write(json.dumps([query for _, _, query in jobs]))
 
-        return self._build_relationships_graph(
+        # Blocks are cached once all their queries are completed
+        completed_blocks = {
+            block_key: [None] * len(block)
+            for block_key, block in missing_blocks.items()
+        }
+
+        remaining = {
+            block_key: len(block)
+            for block_key, block in missing_blocks.items()
+        }
+
+        for (block_key, idx, query), paths in self._iter_completed_queries(jobs, deadline=deadline):
+            collection = self._path_collection(query, paths)
+
+            completed_blocks[block_key][idx] = collection
+            remaining[block_key] -= 1
+
+            if remaining[block_key] == 0 and self.cache is not None:
+                self.cache.set(
+                    self._block_cache_key(pairs, block_key),
+                    completed_blocks[block_key]
+                )
+
+            yield (*block_key, idx, collection)
+
+    def _index_path_collections(
+            self,
+            entity1: str,
+            entity2: str,
+            max_distance: int,
+            ignored_objects: list = (),
+            deadline: Deadline = None) -> list:
+        """Returns the path collections of the relationship queries
+        between entity1 and entity2, found in the adjacency index"""
+        return self.adjacency_index().path_collections(
             entity1,
             entity2,
-            output_paths), output_paths
+            max_distance,
+            limit=self.query_result_limit,
+            ignored_objects=ignored_objects,
+            deadline=deadline
+        )
 
-    def _build_relationships_graph(self, src: str, dest: str, path_collections: list):
-        nodes = self.__extract_relationship_nodes(
-            src=src,
-            dest=dest,
-            path_collections=path_collections
+    def _relationship_query_config(
+            self,
+            entity1: str,
+            entity2: str,
+            max_distance: int,
+            ignored_objects: list = ()):
+        return RelationshipQueryConfig(
+            entity1IRI=entity1,
+            entity2IRI=entity2,
+            ignored_objects=list(ignored_objects),
+            ignored_properties=IGNORED_PROPERTIES,
+            allowed_properties=self.allowed_object_properties,
+            avoid_cycles=QueryCyclesStrategy.NO_INTERMEDIATE_DUPLICATES,
+            limit=self.query_result_limit,
+            max_distance=max_distance
         )
 
-        edges = self.__extract_relationship_edges(
-            path_collections=path_collections,
-            nodes=nodes
+    def _path_collection(self, query: dict, paths: list) -> dict:
+        """Returns the path collection of the results of a relationship
+        query. It is marked as truncated if the query returned as many
+        results as its limit, since the endpoint may have more"""
+        return {
+            "src": query["src"],
+            "dest": query["dest"],
+            "layout": query["layout"],
+            "paths": paths,
+            "truncated": self._limit_reached(paths)
+        }
+
+    def _limit_reached(self, paths: list) -> bool:
+        return self.query_result_limit is not None and len(paths) >= self.query_result_limit
+
+    def _rank_paths(self, path_collections: list, max_paths: int = None) -> list:
+        """Keeps the `max_paths` best paths of path_collections, or
+        max_paths if given: the shortest ones, then the ones through
+        the nodes of lowest degree. Degrees are taken from the adjacency
+        index if it is loaded, which is never done just for ranking"""
+        index = self.adjacency.index
+
+        return rank_path_collections(
+            path_collections,
+            self.max_paths if max_paths is None else max_paths,
+            node_degree=None if index is None else index.node_degree
         )
 
-        nodes = [{
-            "label": k.split("/")[-1],
-            "iri": k,
-            "id": nodes[k],
-            "class": "MockClass",
-            "isEndpoint": k in [src, dest]
-        } for k in nodes.keys()]
+    def _block_cache_key(self, pairs: list, block_key: tuple) -> str:
+        pair_idx, distance = block_key
+        entity1, entity2 = pairs[pair_idx]
 
-        return nodes, edges
+        return self._path_block_key(entity1, entity2, distance)
 
-    def merge_edge_duplicates(self, edges: list, label_sep="|"):
+    def _path_block_key(self, entity1: str, entity2: str, distance: int) -> str:
+        """Returns the cache key of the paths at a given distance.
+
+        The paths do not depend on the order of the entities, so
+        the same cache entry serves both orderings
         """
-            Given a list of edges (x --> y) merges duplicates in a
-            single edge with multiple property labels
+        return cache_key(
+            "relationships",
+            PATH_BLOCK_VERSION,
+            sorted([entity1, entity2]),
+            distance,
+            self.config_digest
+        )
+
+    def _iter_completed_queries(self, jobs: list, deadline: Deadline = None):
+        """Executes a list of (block, index, query) relationship jobs,
+        where block identifies the pair and distance of the query, and
+        yields each job with its result bindings as it completes.
+
+        Queries run concurrently on the endpoint executor, so the
+        latency is roughly the one of the slowest query. Queries not
+        started yet are cancelled if the consumer stops iterating.
+        Depending on `query_batching` several jobs are sent in a
+        single UNION request.
+
+        If a `deadline` is given, iteration stops when it expires and
+        the jobs that did not complete are skipped. Running queries use
+        the remaining time as timeout, so they are abandoned as well.
         """
-        edges_dict = {}
-
-        for edge in edges:
-            key = f"{edge['sid']}-{edge['tid']}"
-
-            if key in edges_dict and edge["label"] not in edges_dict[key]["label"]:
-                edges_dict[key]["iris"].append(edge["iri"])
-                edges_dict[key]["label"].append(edge["label"])
-            else:
-                edges_dict[key] = {
-                    "sid": edge["sid"],
-                    "tid": edge["tid"],
-                    "iris": [edge["iri"]],
-                    "label": [edge["label"]]
-                }
-
-        for _, edge in edges_dict.items():
-            # Merge the labels list to a string
-            edge["label"] = f" {label_sep} ".join(edge["label"])
-
-        return [v for _, v in edges_dict.items()]
-
-    def __extract_relationship_nodes(self, src: str, dest: str, path_collections: list):
-        node_idx = 2
-        nodes = {
-            src: 0,
-            dest: 1
-        }
+        batches = self._batch_jobs(jobs)
 
-        for collection in path_collections:
-            for path in collection["paths"]:
-                # Extract all object keys (ofx) from the path
-                obj_keys = [
-                    k for k in list(path.keys())
-                    if self.__is_path_object(k)
-                ]
+        if self.executor is None:
+            for batch in batches:
+                try:
+                    batch_paths = self._run_query_batch(batch, deadline)
+                except QUERY_TIMEOUT_ERRORS:
+                    if deadline is None:
+                        raise
 
-                for k in obj_keys:
-                    # Add the node to the nodes dictionary if
-                    # it does not exist yet
-                    entity = path[k]["value"]
+                    deadline.expired = True
+                    return
 
-                    if entity not in nodes:
-                        nodes[entity] = node_idx
-                        node_idx += 1
+                yield from zip(batch, batch_paths)
 
-        return nodes
+            return
 
-    def __is_path_object(self, key):
-        """Returns whether a SPARQL query element is an object"""
-        return "of" in key or "middle" in key or "os" in key
+        futures = {
+            self.executor.submit(self._run_query_batch, batch, deadline): batch
+            for batch in batches
+        }
 
-    def __extract_relationship_edges(self, path_collections: list, nodes: dict):
-        edges = []
+        timeout = None if deadline is None else deadline.remaining()
 
-        for collection in path_collections:
-            for path in collection["paths"]:
-                path_components = list(path.keys())
+        try:
+            for future in as_completed(futures, timeout=timeout):
+                try:
+                    batch_paths = future.result()
+                except QUERY_TIMEOUT_ERRORS:
+                    if deadline is None:
+                        raise
 
-                if len(path_components) == 1:
-                    # Direct connection
-                    prop = path[
-                        path_components[0]
-                    ]["value"]
+                    deadline.expired = True
+                    continue
 
-                    if prop not in self.allowed_object_properties:
-                        # Skip non-allowed properties
-                        continue
+                yield from zip(futures[future], batch_paths)
+        except FuturesTimeoutError:
+            # Since Python 3.11 this is also the socket timeout error,
+            # which is only expected here without a deadline
+            if deadline is None:
+                raise
 
-                    edges.append({
-                        "sid": nodes[collection["src"]],
-                        "tid": nodes[collection["dest"]],
-                        "iri": prop,
-                        "label": prop.split("/")[-1]
-                    })
-                else:
-                    # Make sure all the properties are in the
-                    # allowed object properties list
-                    if not self.__is_prop_chain_valid(path):
-                        continue
+            deadline.expired = True
+        finally:
+            for future in futures:
+                future.cancel()
 
-                    # Indirect connection
-                    edges.extend(self.__extract_path_edges(
-                        collection["src"],
-                        collection["dest"],
-                        path,
-                        path_components,
-                        nodes
-                    ))
+    def _batch_jobs(self, jobs: list) -> list:
+        """Groups relationship jobs according to `query_batching`. The
+        distance mode groups the jobs of each block, i.e. the queries of
+        a pair (or of the arms of an entity) at a distance"""
+        if self.query_batching == QueryBatching.SEARCH:
+            return [jobs] if jobs else []
 
-        # Keep only unique edges
-        edges = set([json.dumps(e) for e in edges])
-        return [json.loads(e) for e in edges]
+        if self.query_batching == QueryBatching.DISTANCE:
+            batches = {}
 
-    def __is_prop_chain_valid(self, path):
-        """
-            This method verifies that all properties of a path
-            are in the allowed_object_properties list
-        """
-        property_iris = [
-            path[k]["value"] for k in list(path.keys())
-            if k.startswith("pf") or k.startswith("ps")
-        ]
+            for job in jobs:
+                batches.setdefault(job[0], []).append(job)
 
-        valid_iris = [
-            iri for iri in property_iris
-            if iri in self.allowed_object_properties
-        ]
+            return list(batches.values())
 
-        return len(valid_iris) == len(property_iris)
+        return [[job] for job in jobs]
 
-    def __extract_path_edges(self, src: str, dest: str, path: list, path_components: list, nodes: dict):
-        forward_props = [k for k in list(path.keys()) if k.startswith("pf")]
-        forward_props = sorted(forward_props)
+    def _run_query_batch(self, batch: list, deadline: Deadline = None) -> list:
+        """Runs a batch of relationship jobs and returns the result
+        bindings of each job"""
+        # The remaining time is measured when the batch starts
+        timeout = None if deadline is None else deadline.remaining()
 
-        backward_props = [k for k in list(path.keys()) if k.startswith("ps")]
-        backward_props = sorted(backward_props)
+        if len(batch) == 1:
+            return [self._query_bindings(batch[0][2]["query"], timeout=timeout)]
 
-        # Forward links
-        forward_edges = self.__path_to_edges(
-            src=src,
-            dest=dest,
-            props=forward_props,
-            path=path,
-            nodes=nodes,
-            object_key_prefix="of"
-        )
+        bindings = self._query_bindings(union_query([
+            query["query"] for _, _, query in batch
+        ]), timeout=timeout)
 
-        backward_edges = self.__path_to_edges(
-            src=dest,
-            dest=src,
-            props=backward_props,
-            path=path,
-            nodes=nodes,
-            object_key_prefix="os"
-        )
+        # Demultiplex the bindings of each UNION branch
+        batch_paths = [[] for _ in batch]
 
-        return forward_edges + backward_edges
+        for binding in bindings:
+            pattern = binding.pop("pattern")
+            batch_paths[int(pattern["value"])].append(binding)
 
-    def __path_to_edges(
-            self,
-            src: str,
-            dest: str,
-            props: list,
-            path: list,
-            nodes: dict,
-            object_key_prefix="of"):
-        """Extracts edges from a given path.
-        
-        `object_key_prefix` controls whether the direction should be
-        forward (of) or backward (os).
-        
-        current_pos = src
-        object_key_prefix = 'of'
+        return batch_paths
 
-        for each prop:
-            Does ofx exist? If yes link, pos = ofx
-            elif: middle exists? Connect to middle and terminate
-            else: connect to dest and terminate
-        """
-        edges = []
-        current_pos = src
-
-        for idx, prop in enumerate(props):
-            target_obj = f"{object_key_prefix}{idx + 1}"
-
-            if target_obj in path.keys():
-                obj = path[target_obj]["value"]
-
-                edges.append({
-                    "sid": nodes[obj],
-                    "tid": nodes[current_pos],
-                    "iri": path[prop]["value"],
-                    "label": path[prop]["value"].split("/")[-1]
-                })
-
-                current_pos = obj
-            elif "middle" in path.keys():
-                e_src, e_dest = nodes[path["middle"]["value"]], nodes[current_pos]
-
-                edges.append({
-                    "sid": e_src,
-                    "tid": e_dest,
-                    "iri": path[prop]["value"],
-                    "label": path[prop]["value"].split("/")[-1]
-                })
-
-                # No more forward connections after middle
-                break
-            else:
-                # Link to the destination
-                edges.append({
-                    "sid": nodes[current_pos],
-                    "tid": nodes[dest],
-                    "iri": path[prop]["value"],
-                    "label": path[prop]["value"].split("/")[-1]
-                })
-
-        return edges
+    def run_tasks(self, tasks: list) -> list:
+        """Runs a list of (function, *args) tasks on the endpoint
+        executor and returns their results in order"""
+        if self.executor is None:
+            return [task[0](*task[1:]) for task in tasks]
+
+        return list(self.executor.map(lambda task: task[0](*task[1:]), tasks))
+
+    def _query_bindings(self, query: str, timeout: float = None) -> list:
+        """Runs a query and returns its result bindings"""
+        return self.client.query(query, timeout=timeout)["results"]["bindings"]
+
+    def _build_relationships_graph(self, src: str, dest: str, path_collections: list) -> RelationshipGraph:
+        return add_path_collections(
+            RelationshipGraph([src, dest]),
+            path_collections,
+            self.allowed_properties
+        )
@@ -0,0 +1,304 @@
+# Copyright (C) <2021>  <Kody Moodley and Walter Simoncini>
+# License: https://www.gnu.org/licenses/agpl-3.0.txt
+
+"""Construction of relationship graphs from the results of the
+relationship queries"""
+import heapq
+
+from array import array
+from collections import Counter
+
+from api.helpers.sparql.relationships import (
+    LAYOUT_SRC,
+    LAYOUT_DEST
+)
+
+
+def iri_label(iri: str) -> str:
+    """Returns the placeholder label of an IRI without rdfs:label"""
+    return iri.split("/")[-1]
+
+
+class RelationshipGraph():
+    """Relationship graph with interned node and property IRIs.
+
+    Nodes and properties are identified by their index in `iris` and
+    `properties`. Edges are stored column-wise in integer arrays and
+    grouped by node pair in `edge_pairs`, which maps (source, target)
+    IDs to the ordered set of their property IDs: edges are merged
+    while they are added. Labels and classes are filled in place and
+    the graph is turned into the response dictionaries only once, by
+    `serialize`.
+    """
+    __slots__ = (
+        "iris",
+        "node_ids",
+        "endpoints",
+        "labels",
+        "classes",
+        "properties",
+        "property_ids",
+        "property_labels",
+        "edge_sources",
+        "edge_targets",
+        "edge_props",
+        "edge_pairs",
+        "truncated"
+    )
+
+    def __init__(self, endpoints: list = ()) -> None:
+        self.iris = []
+        self.node_ids = {}
+        self.endpoints = set()
+
+        # None until set from the endpoint labels and types
+        self.labels = []
+        self.classes = []
+
+        self.properties = []
+        self.property_ids = {}
+        self.property_labels = []
+
+        self.edge_sources = array("l")
+        self.edge_targets = array("l")
+        self.edge_props = array("l")
+        self.edge_pairs = {}
+
+        # Whether paths were left out because of the query result
+        # limit or of the maximum number of paths
+        self.truncated = False
+
+        for iri in endpoints:
+            self.add_node(iri, endpoint=True)
+
+    def __len__(self):
+        return len(self.iris)
+
+    @property
+    def edge_count(self) -> int:
+        return len(self.edge_sources)
+
+    def add_node(self, iri: str, endpoint: bool = False) -> int:
+        """Returns the ID of a node, adding it if missing"""
+        idx = self.node_ids.get(iri)
+
+        if idx is None:
+            idx = self.node_ids[iri] = len(self.iris)
+
+            self.iris.append(iri)
+            self.labels.append(None)
+            self.classes.append(None)
+
+        if endpoint:
+            self.endpoints.add(idx)
+
+        return idx
+
+    def add_property(self, iri: str) -> int:
+        """Returns the ID of a property, adding it if missing"""
+        idx = self.property_ids.get(iri)
+
+        if idx is None:
+            idx = self.property_ids[iri] = len(self.properties)
+
+            self.properties.append(iri)
+            self.property_labels.append(iri_label(iri))
+
+        return idx
+
+    def add_edge(self, sid: int, tid: int, prop: int) -> bool:
+        """Adds an edge between two node IDs. Returns whether the
+        edge was new"""
+        pair_props = self.edge_pairs.setdefault((sid, tid), {})
+
+        if prop in pair_props:
+            return False
+
+        # Dictionaries are used as insertion ordered sets
+        pair_props[prop] = None
+
+        self.edge_sources.append(sid)
+        self.edge_targets.append(tid)
+        self.edge_props.append(prop)
+
+        return True
+
+    def set_labels(self, labels_map: dict):
+        """Sets the labels of the nodes and properties in labels_map"""
+        for idx, iri in enumerate(self.iris):
+            if iri in labels_map:
+                self.labels[idx] = labels_map[iri]
+
+        for idx, iri in enumerate(self.properties):
+            if iri in labels_map:
+                self.property_labels[idx] = labels_map[iri]
+
+    def set_classes(self, types_map: dict, default: str = "Thing"):
+        """Sets the class of every node, using default for the nodes
+        missing from types_map"""
+        self.classes = [types_map.get(iri, default) for iri in self.iris]
+
+    def node_label(self, idx: int) -> str:
+        label = self.labels[idx]
+
+        return iri_label(self.iris[idx]) if label is None else label
+
+    def node_class(self, idx: int) -> str:
+        node_class = self.classes[idx]
+
+        return "MockClass" if node_class is None else node_class
+
+    def serialize_nodes(self, start: int = 0) -> list:
+        """Returns the nodes with ID start or greater as dictionaries"""
+        return [{
+            "label": self.node_label(idx),
+            "iri": self.iris[idx],
+            "id": idx,
+            "class": self.node_class(idx),
+            "isEndpoint": idx in self.endpoints
+        } for idx in range(start, len(self.iris))]
+
+    def serialize_edges(self, start: int = 0) -> list:
+        """Returns the edges added after the first start ones as
+        dictionaries"""
+        return [{
+            "sid": sid,
+            "tid": tid,
+            "iri": self.properties[prop],
+            "label": self.property_labels[prop]
+        } for sid, tid, prop in zip(
+            self.edge_sources[start:],
+            self.edge_targets[start:],
+            self.edge_props[start:]
+        )]
+
+    def serialize_merged_edges(self, label_sep: str = "|") -> list:
+        """Returns one edge per (source, target) node pair, with the
+        IRIs of its properties and their labels joined by label_sep.
+        Properties sharing a label are only listed once"""
+        edges = []
+
+        for (sid, tid), props in self.edge_pairs.items():
+            labels = {}
+
+            for prop in props:
+                labels.setdefault(self.property_labels[prop], self.properties[prop])
+
+            edges.append({
+                "sid": sid,
+                "tid": tid,
+                "iris": list(labels.values()),
+                "label": f" {label_sep} ".join(labels.keys())
+            })
+
+        return edges
+
+    def class_list(self) -> list:
+        return list(set(self.node_class(idx) for idx in range(len(self.iris))))
+
+    def serialize(self, merge_edges: bool = True) -> dict:
+        """Returns the response dictionary of the graph. If merge_edges
+        is True edges between the same nodes are merged"""
+        if merge_edges:
+            edges = self.serialize_merged_edges()
+        else:
+            edges = self.serialize_edges()
+
+        return {
+            "nodes": self.serialize_nodes(),
+            "edges": edges,
+            "classes": self.class_list()
+        }
+
+
+def add_path_collections(graph: RelationshipGraph, path_collections: list, allowed_properties: frozenset):
+    """Adds the nodes and edges of the relationship query results in
+    path_collections to graph. The nodes of all the paths are added
+    first; edges are only added for the paths whose properties are all
+    in allowed_properties. The graph is marked as truncated if any of
+    the collections is"""
+    for collection in path_collections:
+        if collection.get("truncated", False):
+            graph.truncated = True
+
+        node_vars = collection["layout"]["nodes"]
+
+        if not node_vars:
+            continue
+
+        for path in collection["paths"]:
+            for var in node_vars:
+                graph.add_node(path[var]["value"])
+
+    node_ids = graph.node_ids
+
+    for collection in path_collections:
+        edge_specs = collection["layout"]["edges"]
+        entities = {
+            LAYOUT_SRC: collection["src"],
+            LAYOUT_DEST: collection["dest"]
+        }
+
+        for path in collection["paths"]:
+            props = [path[pred]["value"] for pred, _, _ in edge_specs]
+
+            if not allowed_properties.issuperset(props):
+                # Skip paths with non-allowed properties
+                continue
+
+            for prop, (_, sid, tid) in zip(props, edge_specs):
+                graph.add_edge(
+                    node_ids[entities[sid] if sid in entities else path[sid]["value"]],
+                    node_ids[entities[tid] if tid in entities else path[tid]["value"]],
+                    graph.add_property(prop)
+                )
+
+    return graph
+
+
+def rank_path_collections(path_collections: list, max_paths: int, node_degree=None) -> list:
+    """Returns path_collections keeping only their max_paths best paths,
+    in their original order. Collections which lose paths are marked
+    as truncated.
+
+    Shorter paths rank first and paths of the same length are ranked by
+    the total degree of their intermediate nodes, so that paths through
+    hub nodes are dropped first. node_degree maps a node IRI to its
+    degree; if None the number of paths through each node in
+    path_collections is used instead.
+    """
+    if max_paths is None or sum(len(c["paths"]) for c in path_collections) <= max_paths:
+        return path_collections
+
+    def path_nodes(collection):
+        node_vars = collection["layout"]["nodes"]
+
+        for path in collection["paths"]:
+            yield [path[var]["value"] for var in node_vars]
+
+    if node_degree is None:
+        counts = Counter(
+            node
+            for collection in path_collections
+            for nodes in path_nodes(collection)
+            for node in nodes
+        )
+
+        node_degree = counts.__getitem__
+
+    best = heapq.nsmallest(max_paths, (
+        (len(collection["layout"]["edges"]), sum(map(node_degree, nodes)), cidx, pidx)
+        for cidx, collection in enumerate(path_collections)
+        for pidx, nodes in enumerate(path_nodes(collection))
+    ))
+
+    kept = [set() for _ in path_collections]
+
+    for _, _, cidx, pidx in best:
+        kept[cidx].add(pidx)
+
+    return [{
+        **collection,
+        "paths": [path for pidx, path in enumerate(collection["paths"]) if pidx in kept[cidx]],
+        "truncated": collection.get("truncated", False) or len(kept[cidx]) < len(collection["paths"])
+    } for cidx, collection in enumerate(path_collections)]
@@ -17,7 +17,12 @@ def uri(iri, prefixes=IRI_PREFIXES):
     1. If the IRI can be prefixed, prefixes it and returns
     2. If the IRI is already prefixes the IRI is returned
     3. Puts brackets around an IRI, e.g. <iri>
+
+    SPARQL variables (?var or $var) are returned unchanged.
     """
+    if iri.startswith("?") or iri.startswith("$"):
+        return iri
+
     for item in list(prefixes.keys()):
         if iri.startswith(prefixes[item]):
             iri = iri.replace(
@@ -48,16 +53,6 @@ def expand_terms(terms, operator="&&"):
     """Given a list of terms produces a string in the
     format ((term1) && (term2) && ...) where "&&" is
     the `operator` parameter"""
-    result = ""
-
-    for x in range(0, len(terms)):
-        result = f"{result}({terms[x]})"
-
-        if ((x + 1) == len(terms)):
-            result = result + ""
-        else:
-            result = result + " " + operator + " "
-
-        result = result + "\n"
+    result = f" {operator} \n".join([f"({term})" for term in terms])
 
-    return f"({result})"
+    return f"({result}\n)"
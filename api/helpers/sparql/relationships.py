@@ -1,6 +1,10 @@
 # Copyright (C) <2021>  <Kody Moodley and Walter Simoncini>
 # License: https://www.gnu.org/licenses/agpl-3.0.txt
 
+import re
+
+from functools import lru_cache
+
 from api.helpers.sparql.query_utils import IRI_PREFIXES
 from api.helpers.sparql.query_utils import (
     uri,
@@ -15,52 +19,301 @@ from api.helpers.sparql.structs import (
 )
 
 
+# Entities are bound late: query templates refer to them with these
+# variables, which are replaced by the entity IRIs for each request
+ENTITY1_VAR = "$entity1"
+ENTITY2_VAR = "$entity2"
+
+ENTITY_VAR_PATTERN = re.compile(r"\$entity([12])\b")
+
+# Placeholders of the source and destination entities in the
+# variable layouts of the queries
+LAYOUT_SRC = "$src"
+LAYOUT_DEST = "$dest"
+
+# Characters which can not occur in an IRI written as <iri>
+INVALID_IRI_CHARS = re.compile(r'[<>"{}|^`\\\s]')
+
+
 def get_queries(query_config: RelationshipQueryConfig):
     """Returns a set of queries to find relations between two objects."""
-    queries = {}
+    return {
+        distance: get_distance_queries(query_config, distance)
+        for distance in range(1, query_config.max_distance + 1)
+    }
 
-    for distance in range(1, query_config.max_distance + 1):
-        # get direct connection in both directions
-        queries[distance] = []
 
-        direct_query = {
-            "query": direct(query_config, distance, RelationshipDirection.FORWARD),
-            "src": query_config.entity1IRI,
-            "dest": query_config.entity2IRI
-        }
+def get_distance_queries(query_config: RelationshipQueryConfig, distance: int) -> list:
+    """Returns the queries of get_queries for a single distance: the
+    direct connections, then the middle object queries"""
+    settings = template_settings(query_config)
+    directions = (RelationshipDirection.FORWARD, RelationshipDirection.BACKWARD)
 
-        reverse_query = {
-            "query": direct(query_config, distance, RelationshipDirection.BACKWARD),
-            "src": query_config.entity2IRI,
-            "dest": query_config.entity1IRI
-        }
+    queries = [
+        bind_entities(query_template(distance, 0, 0, direction, *settings), query_config)
+        for direction in directions
+    ]
 
-        queries[distance].extend([direct_query, reverse_query])
-
-        for a in range(1, distance + 1):
-            for b in range(1, distance + 1):
-                if ((a + b) == distance):
-                    queries[distance].append(middle_object_query(
-                        query_config.entity1IRI,
-                        query_config.entity2IRI,
-                        a,
-                        b,
-                        to_object=True,
-                        query_config=query_config
-                    ))
-
-                    queries[distance].append(middle_object_query(
-                        query_config.entity1IRI,
-                        query_config.entity2IRI,
-                        a,
-                        b,
-                        to_object=False,
-                        query_config=query_config
-                    ))
+    for a in range(1, distance):
+        for direction in directions:
+            queries.append(bind_entities(
+                query_template(distance, a, distance - a, direction, *settings),
+                query_config
+            ))
 
     return queries
 
 
+def get_direct_queries(query_config: RelationshipQueryConfig):
+    """Returns the direct connection queries between two objects, in
+    both directions, for each distance"""
+    settings = template_settings(query_config)
+
+    return {
+        distance: [
+            bind_entities(
+                query_template(distance, 0, 0, direction, *settings),
+                query_config
+            )
+            for direction in (RelationshipDirection.FORWARD, RelationshipDirection.BACKWARD)
+        ]
+        for distance in range(1, query_config.max_distance + 1)
+    }
+
+
+def template_settings(query_config: RelationshipQueryConfig) -> tuple:
+    """Returns the template parameters shared by all the queries"""
+    return (
+        query_config.avoid_cycles,
+        tuple(query_config.ignored_objects),
+        tuple(query_config.ignored_properties),
+        tuple(query_config.allowed_properties),
+        query_config.limit
+    )
+
+
+@lru_cache(maxsize=1024)
+def query_template(
+        distance: int,
+        a: int,
+        b: int,
+        direction: RelationshipDirection,
+        avoid_cycles: QueryCyclesStrategy,
+        ignored_objects: tuple,
+        ignored_properties: tuple,
+        allowed_properties: tuple,
+        limit: int):
+    """Returns a memoized relationship query template.
+
+    If `a` and `b` are 0 the template is a direct connection query in
+    the given direction, otherwise it is a middle object query with
+    dist1 = a and dist2 = b where FORWARD means to_object. Templates
+    refer to the entities with the ENTITY1_VAR and ENTITY2_VAR
+    variables, so they are valid parametrized SPARQL queries.
+    """
+    template_config = RelationshipQueryConfig(
+        entity1IRI=ENTITY1_VAR,
+        entity2IRI=ENTITY2_VAR,
+        ignored_objects=list(ignored_objects),
+        ignored_properties=list(ignored_properties),
+        allowed_properties=list(allowed_properties),
+        avoid_cycles=avoid_cycles,
+        limit=limit,
+        max_distance=distance
+    )
+
+    if a == 0 and b == 0:
+        src, dest = ENTITY1_VAR, ENTITY2_VAR
+
+        if direction == RelationshipDirection.BACKWARD:
+            src, dest = dest, src
+
+        return {
+            "query": direct(template_config, distance, direction),
+            "src": src,
+            "dest": dest,
+            "layout": direct_layout(distance)
+        }
+
+    template = middle_object_query(
+        ENTITY1_VAR,
+        ENTITY2_VAR,
+        a,
+        b,
+        to_object=direction == RelationshipDirection.FORWARD,
+        query_config=template_config
+    )
+
+    template["layout"] = middle_object_layout(a, b)
+
+    return template
+
+
+def direct_layout(distance: int) -> dict:
+    """Returns the variable layout of a direct connection query.
+
+    The layout lists the variables bound to intermediate nodes and the
+    (property, source, target) variables of each edge of a path, where
+    LAYOUT_SRC and LAYOUT_DEST stand for the queried entities.
+    Intermediate edges point towards the source entity.
+    """
+    objects = [f"of{i}" for i in range(1, distance)]
+    edges = []
+    current = LAYOUT_SRC
+
+    for idx, obj in enumerate(objects):
+        edges.append((f"pf{idx + 1}", obj, current))
+        current = obj
+
+    edges.append((f"pf{distance}", current, LAYOUT_DEST))
+
+    return {
+        "nodes": tuple(objects),
+        "edges": tuple(edges)
+    }
+
+
+def middle_object_layout(dist1: int, dist2: int) -> dict:
+    """Returns the variable layout of a middle object query, see
+    `direct_layout`. Both chains of edges point from the middle
+    object towards the queried entities"""
+    nodes = ["middle"]
+    edges = []
+
+    for fs, entity, distance in (("f", LAYOUT_SRC, dist1), ("s", LAYOUT_DEST, dist2)):
+        objects = [f"o{fs}{i}" for i in range(1, distance)]
+        current = entity
+
+        for idx, obj in enumerate(objects):
+            edges.append((f"p{fs}{idx + 1}", obj, current))
+            current = obj
+
+        edges.append((f"p{fs}{distance}", "middle", current))
+        nodes.extend(objects)
+
+    return {
+        "nodes": tuple(nodes),
+        "edges": tuple(edges)
+    }
+
+
+def bind_entities(template: dict, query_config: RelationshipQueryConfig):
+    """Binds the entities of query_config to a query template"""
+    entities = {
+        ENTITY1_VAR: query_config.entity1IRI,
+        ENTITY2_VAR: query_config.entity2IRI
+    }
+
+    for iri in entities.values():
+        validate_iri(iri)
+
+    terms = {
+        "1": uri(query_config.entity1IRI),
+        "2": uri(query_config.entity2IRI)
+    }
+
+    return {
+        "query": ENTITY_VAR_PATTERN.sub(
+            lambda match: terms[match.group(1)],
+            template["query"]
+        ),
+        "src": entities[template["src"]],
+        "dest": entities[template["dest"]],
+        "layout": template["layout"]
+    }
+
+
+def validate_iri(iri: str):
+    if INVALID_IRI_CHARS.search(iri):
+        raise ValueError(f"Invalid entity IRI: {iri}")
+
+
+def arm_query(
+        entity: str,
+        distance: int,
+        direction: RelationshipDirection,
+        query_config: RelationshipQueryConfig,
+        entities: list):
+    """Returns the query of a one-sided arm of the middle object queries,
+    entity-->?of1-->...-->?middle (arrows reversed if direction is
+    BACKWARD), with `distance` properties.
+
+    The arms of an entity are shared by all the pairs it is part of and
+    are joined on ?middle with `join_arms`. Intermediate objects can
+    not be any of the searched `entities`.
+    """
+    validate_iri(entity)
+
+    arm_config = RelationshipQueryConfig(
+        entity1IRI=entity,
+        entity2IRI=entity,
+        ignored_objects=query_config.ignored_objects + [
+            other for other in entities if other != entity
+        ],
+        ignored_properties=query_config.ignored_properties,
+        allowed_properties=query_config.allowed_properties,
+        avoid_cycles=query_config.avoid_cycles,
+        limit=query_config.limit,
+        max_distance=distance
+    )
+
+    core_query, variables = generate_middle_object_query(
+        core_query="",
+        object=entity,
+        distance=distance,
+        fs="f",
+        to_object=direction == RelationshipDirection.FORWARD
+    )
+
+    variables["obj"].insert(0, "?middle")
+
+    return complete_query(arm_config, core_query, variables)
+
+
+def join_arms(first: list, second: list) -> list:
+    """Joins the result bindings of the arms of two entities on ?middle.
+
+    The joined bindings have the variables of the middle object query
+    results: the ?pf/?of variables of the second arm are renamed to
+    ?ps/?os. Joined paths whose arms share an intermediate object are
+    discarded, as the middle object queries do.
+    """
+    second_arms = {}
+
+    for binding in second:
+        renamed, objects = {}, set()
+
+        for var, value in binding.items():
+            if var == "middle":
+                continue
+
+            if var.startswith("of"):
+                objects.add(value["value"])
+
+            renamed[f"{var[0]}s{var[2:]}"] = value
+
+        second_arms.setdefault(binding["middle"]["value"], []).append((renamed, objects))
+
+    paths = []
+
+    for binding in first:
+        candidates = second_arms.get(binding["middle"]["value"])
+
+        if not candidates:
+            continue
+
+        objects = set(
+            value["value"] for var, value in binding.items()
+            if var.startswith("of")
+        )
+
+        for renamed, second_objects in candidates:
+            if objects.isdisjoint(second_objects):
+                paths.append({**binding, **renamed})
+
+    return paths
+
+
 def direct(query_config, distance, direction=RelationshipDirection.FORWARD):
     """Returns a query for a direct connection between two entities,
     specified in the `query_config` object.
@@ -234,7 +487,8 @@ def generate_middle_object_query(core_query, object, distance, fs, to_object):
 
 
 def generate_filter(query_config, variables: dict):
-    """Adds filters for ignored object and properties.
+    """Adds filters for allowed properties and ignored objects and
+    properties.
     
     The `variables` dictionary should have the following form:
     
@@ -245,49 +499,86 @@ def generate_filter(query_config, variables: dict):
     """
     filter_terms = []
 
-    for prop in variables["pred"]:
-        # Filter out ignored properties
-        for ignored_prop in query_config.ignored_properties:
-            filter_terms.append(f"{prop} != {uri(ignored_prop)} ")
+    if query_config.allowed_properties:
+        # Restrict properties to the whitelist, so that the endpoint
+        # prunes the search instead of returning paths which would be
+        # discarded afterwards. Ignored properties are left out of it
+        allowed_props = ", ".join([
+            uri(prop) for prop in query_config.allowed_properties
+            if prop not in query_config.ignored_properties
+        ])
+
+        for prop in variables["pred"]:
+            filter_terms.append(f"{prop} IN ({allowed_props})")
+    else:
+        for prop in variables["pred"]:
+            # Filter out ignored properties
+            for ignored_prop in query_config.ignored_properties:
+                filter_terms.append(f"{prop} != {uri(ignored_prop)} ")
 
-    for obj in variables["obj"]:
+    if variables["obj"]:
         # Ignore literals
-        filter_terms.append(f"!isLiteral({obj})")
+        filter_terms.append(" && ".join([
+            f"!isLiteral({obj})" for obj in variables["obj"]
+        ]))
 
+    for idx, obj in enumerate(variables["obj"]):
         # Filter out ignored objects
-        for ignored_obj in query_config.ignored_objects:
-            filter_terms.append(f"{obj} != {uri(ignored_obj)} ")
+        excluded = [uri(ignored_obj) for ignored_obj in query_config.ignored_objects]
 
         if query_config.avoid_cycles != QueryCyclesStrategy.NONE:
             # Cycle avoidance
-            entity1_uri, entity2_uri = (
+            excluded.extend([
                 uri(query_config.entity1IRI),
                 uri(query_config.entity2IRI)
-            )
-
-            filter_terms.append(f"{obj} != {entity1_uri} ")
-            filter_terms.append(f"{obj} != {entity2_uri} ")
+            ])
 
             if query_config.avoid_cycles == QueryCyclesStrategy.NO_INTERMEDIATE_DUPLICATES:
-                for other_obj in variables['obj']:
-                    if obj != other_obj:
-                        filter_terms.append(f"{obj} != {other_obj} ")
+                # Each pair of objects is compared only once
+                excluded.extend(variables["obj"][idx + 1:])
+
+        if excluded:
+            excluded = list(dict.fromkeys(excluded))
+            filter_terms.append(f"{obj} NOT IN ({', '.join(excluded)})")
 
     expanded_terms = expand_terms(filter_terms, "&&")
 
     return f"FILTER {expanded_terms}. "
 
 
-def complete_query(query_config, core_query, variables):
-    """Adds prefixes and suffixes to a SPARQL query, along
-    with the query filters"""
-    out_query = '';
+PREFIXES_HEADER = "".join([
+    f"PREFIX {item}: <{IRI_PREFIXES[item]}>\n" for item in IRI_PREFIXES
+])
+
+QUERY_HEADER = f"{PREFIXES_HEADER}SELECT * WHERE {{\n"
 
-    for item in IRI_PREFIXES:
-        out_query = f"{out_query}PREFIX {item}: <{IRI_PREFIXES[item]}>\n"
 
-    out_query = f"{out_query}SELECT * WHERE {{\n"
+def complete_query(query_config, core_query, variables):
+    """Adds prefixes and suffixes to a SPARQL query, along
+    with the query filters and the result limit"""
+    out_query = QUERY_HEADER
     out_query = f"{out_query}{core_query}\n"
     out_query = f"{out_query}{generate_filter(query_config, variables)}\n}}"
 
+    if query_config.limit is not None:
+        out_query = f"{out_query}\nLIMIT {query_config.limit}"
+
     return out_query
+
+
+def union_query(queries: list):
+    """Combines a list of queries produced by `complete_query` in a
+    single query. Each query becomes a UNION branch which binds the
+    ?pattern variable to the index of the query in the list. Queries
+    with a LIMIT become sub-queries, so that it applies per branch"""
+    branches = []
+
+    for idx, query in enumerate(queries):
+        where, _, limit = query[len(QUERY_HEADER):].rpartition("}")
+
+        if limit.strip():
+            where = f"{{ SELECT * WHERE {{\n{where}}} {limit.strip()} }}\n"
+
+        branches.append(f"{{\n{where}BIND({idx} AS ?pattern)\n}}")
+
+    return f"{QUERY_HEADER}{' UNION '.join(branches)}\n}}"
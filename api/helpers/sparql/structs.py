@@ -20,6 +20,29 @@ class RelationshipDirection(Enum):
     BACKWARD = 1
 
 
+class RelationshipEngine(Enum):
+    """Engine used to find relationships between entities.
+
+    - SPARQL:   one SPARQL query per path pattern, executed by the endpoint
+    - INDEX:    path search over an in-memory adjacency index of the
+                object-property subgraph
+    """
+    SPARQL = "sparql"
+    INDEX = "index"
+
+
+class QueryBatching(Enum):
+    """How relationship queries are grouped in SPARQL requests.
+
+    - NONE:         one request per query
+    - DISTANCE:     one UNION request per distance
+    - SEARCH:       one UNION request for the whole search
+    """
+    NONE = "none"
+    DISTANCE = "distance"
+    SEARCH = "search"
+
+
 class RelationshipQueryConfig():
     """Configuration used to generate relationship queries
     between two objects.
@@ -35,8 +58,11 @@ class RelationshipQueryConfig():
     - ignored_properties:   properties which should not be part
                             of the returned connections between
                             the first and second object.
+    - allowed_properties:   if not empty, the only properties which
+                            can be part of the returned connections.
     - avoid_cycles:         cycle avoidance strategy
-    - limit:                maximum number of results per SPARQL query
+    - limit:                maximum number of results per SPARQL query,
+                            None for no limit
     - max_distance:         the maximum search distance
     """
     def __init__(
@@ -45,11 +71,15 @@ class RelationshipQueryConfig():
             entity2IRI: str,
             ignored_objects=[],
             ignored_properties=[],
+            allowed_properties=[],
             avoid_cycles=QueryCyclesStrategy.NONE,
+            limit: int = None,
             max_distance: int = 4) -> None:
         self.entity1IRI = entity1IRI
         self.entity2IRI = entity2IRI
         self.ignored_objects = ignored_objects
         self.ignored_properties = ignored_properties
+        self.allowed_properties = allowed_properties
         self.avoid_cycles = avoid_cycles
+        self.limit = limit
         self.max_distance = max_distance
@@ -1,11 +1,11 @@
 # Copyright (C) <2021>  <Kody Moodley and Walter Simoncini>
 # License: https://www.gnu.org/licenses/agpl-3.0.txt
 
-import json
-
 from flask import request
 from functools import wraps
 
+from api.helpers.responses import json_response
+
 from .validators import ValidationSchema
 
 
@@ -18,9 +18,9 @@ def validate_json(schema: ValidationSchema):
             )
 
             if not is_valid:
-                return json.dumps({
+                return json_response({
                     "message": validation_error
-                }), 400
+                }, status=400)
 
             return f(*args, **kwargs)
 
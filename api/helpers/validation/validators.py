@@ -7,39 +7,61 @@ import json
 
 from enum import Enum
 
-from jsonschema.exceptions import ValidationError
-from jsonschema import validate, FormatChecker
+from jsonschema import FormatChecker
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
+
+
+# Schemas are resolved relative to the api package, not the CWD
+SCHEMAS_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    "validation_schemas"
+)
 
 
 class ValidationSchema(Enum):
     QUERY = "query"
     DATAPROPS = "dataprops"
+    BATCH = "batch"
 
     @classmethod
     def load_schema(cls, schema):
-        return json.loads(open(
-            ValidationSchema.filename_for_schema(schema)
-        ).read())
+        with open(ValidationSchema.filename_for_schema(schema)) as schema_file:
+            return json.load(schema_file)
 
     @classmethod
     def filename_for_schema(cls, schema):
         filename = {
             ValidationSchema.QUERY: "query.json",
-            ValidationSchema.DATAPROPS: "dataprops.json"
+            ValidationSchema.DATAPROPS: "dataprops.json",
+            ValidationSchema.BATCH: "batch.json"
         }[schema]
 
-        return os.path.join("api/validation_schemas", filename)
+        return os.path.join(SCHEMAS_DIR, filename)
 
-    def validate(self, instance: dict):
-        schema = ValidationSchema.load_schema(self)
+    @classmethod
+    def compile_schema(cls, schema):
+        """Returns a validator for a schema, checking that the
+        schema itself is valid"""
+        schema_dict = ValidationSchema.load_schema(schema)
+        validator_class = validator_for(schema_dict)
+        validator_class.check_schema(schema_dict)
 
-        try:
-            validate(
-                instance=instance,
-                schema=schema,
-                format_checker=FormatChecker()
-            )
+        return validator_class(schema_dict, format_checker=FormatChecker())
 
+    def validate(self, instance: dict):
+        # Same error as jsonschema.validate, without reloading the schema
+        error = best_match(VALIDATORS[self].iter_errors(instance))
+
+        if error is None:
             return True, None
-        except ValidationError as ex:
-            return False, ex.message
+
+        return False, error.message
+
+
+# Validators are compiled once at import, so validating a
+# request does no file I/O
+VALIDATORS = {
+    schema: ValidationSchema.compile_schema(schema)
+    for schema in ValidationSchema
+}
@@ -0,0 +1,38 @@
+# Copyright (C) <2021>  <Kody Moodley and Walter Simoncini>
+# License: https://www.gnu.org/licenses/agpl-3.0.txt
+
+"""gunicorn hooks that build the entity catalogue and the class
+statistics once for all the workers: the master starts `api.builder`
+in a separate process, which saves them to the artifact paths of
+config.json, and each worker reloads the artifacts when they change.
+"""
+import sys
+import subprocess
+
+builder = None
+
+
+def on_starting(server):
+    global builder
+
+    builder = subprocess.Popen([sys.executable, "-m", "api.builder"])
+    server.log.info("Started the catalogue builder (pid: %s)", builder.pid)
+
+
+def post_worker_init(worker):
+    from api.app import start_background_refresh
+
+    start_background_refresh(build=False)
+
+
+def worker_exit(server, worker):
+    from api.app import app
+
+    # Closes the idle keep-alive connections to the SPARQL endpoint
+    app.sparql.client.close()
+
+
+def on_exit(server):
+    if builder is not None:
+        builder.terminate()
+        builder.wait()
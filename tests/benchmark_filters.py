@@ -0,0 +1,93 @@
+# Copyright (C) <2021>  <Kody Moodley and Walter Simoncini>
+# License: https://www.gnu.org/licenses/agpl-3.0.txt
+
+"""Compares the size and planning time of the relationship queries
+generated with the legacy and the compact cycle-avoidance filters.
+
+Run with `python -m tests.benchmark_filters`. Importing the api package
+creates the app, so the SPARQL_ENDPOINT, SPARQL_USERNAME and
+SPARQL_PASSWORD variables must be set (e.g. in the .env file) even when
+the queries are not timed on the endpoint.
+"""
+import time
+import click
+import statistics
+
+from unittest import mock
+
+from api.app import app
+from api.helpers.sparql import relationships
+from api.helpers.sparql.structs import (
+    QueryCyclesStrategy,
+    RelationshipQueryConfig
+)
+
+from tests.test_filters import legacy_generate_filter
+
+
+def time_queries(client, queries: list, repeat: int) -> float:
+    """Returns the median time in seconds to run all the queries with
+    LIMIT 0, which approximates the endpoint parsing and planning time"""
+    timings = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+
+        for query in queries:
+            client.query(f"{query} LIMIT 0")
+
+        timings.append(time.perf_counter() - start)
+
+    return statistics.median(timings)
+
+
+@click.command()
+@click.option("--max-distance", type=int, default=6)
+@click.option("--endpoint/--no-endpoint", default=False, help="Time the queries on the SPARQL endpoint")
+@click.option("--repeat", type=int, default=3)
+def benchmark_filters(max_distance, endpoint, repeat):
+    client = None
+
+    if endpoint:
+        client = app.sparql.client
+
+    for distance in range(1, max_distance + 1):
+        query_config = RelationshipQueryConfig(
+            entity1IRI="http://w3id.org/um/cbcm/eu-cm-ontology#entity1",
+            entity2IRI="http://w3id.org/um/cbcm/eu-cm-ontology#entity2",
+            ignored_properties=[
+                "http://www.w3.org/1999/02/22-rdf-syntax-ns#type",
+                "http://www.w3.org/2004/02/skos/core#subject"
+            ],
+            avoid_cycles=QueryCyclesStrategy.NO_INTERMEDIATE_DUPLICATES,
+            max_distance=distance
+        )
+
+        compact = [q["query"] for q in relationships.get_queries(query_config)[distance]]
+
+        # Query templates are memoized, so they are rebuilt around
+        # the generation of the legacy queries
+        relationships.query_template.cache_clear()
+
+        with mock.patch.object(relationships, "generate_filter", legacy_generate_filter):
+            legacy = [q["query"] for q in relationships.get_queries(query_config)[distance]]
+
+        relationships.query_template.cache_clear()
+
+        report = (
+            f"distance {distance}: {len(compact)} queries, "
+            f"legacy {sum(map(len, legacy))} bytes, "
+            f"compact {sum(map(len, compact))} bytes"
+        )
+
+        if client is not None:
+            report = (
+                f"{report}, legacy {time_queries(client, legacy, repeat) * 1000:.1f} ms, "
+                f"compact {time_queries(client, compact, repeat) * 1000:.1f} ms"
+            )
+
+        click.echo(report)
+
+
+if __name__ == '__main__':
+    benchmark_filters()
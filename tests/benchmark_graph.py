@@ -0,0 +1,239 @@
+# Copyright (C) <2021>  <Kody Moodley and Walter Simoncini>
+# License: https://www.gnu.org/licenses/agpl-3.0.txt
+
+"""Compares building and merging the relationship graph with the
+dictionaries of the original port and with the interned graph, on
+synthetic data.
+
+Run with `python -m tests.benchmark_graph build` or `merge`. Importing
+the api package creates the app, so the SPARQL_* variables of the .env
+file must be set, although the endpoint is not queried.
+"""
+import json
+import time
+import click
+import random
+import statistics
+
+from api.helpers.sparql import relationships
+from api.helpers.sparql.graph import (
+    add_path_collections,
+    RelationshipGraph
+)
+from api.helpers.sparql.structs import RelationshipQueryConfig
+
+from tests.test_graph import merge_edge_duplicates
+
+
+def legacy_relationship_edges(node_ids: dict, path_collections: list, allowed_properties: list) -> list:
+    """Edge extraction of the original port, which scans the variables
+    of every binding and deduplicates edges through JSON. Used as
+    benchmark baseline"""
+    edges = []
+
+    def to_edge(sid, tid, prop):
+        return {"sid": sid, "tid": tid, "iri": prop, "label": prop.split("/")[-1]}
+
+    for collection in path_collections:
+        src, dest = collection["src"], collection["dest"]
+
+        for path in collection["paths"]:
+            keys = list(path.keys())
+
+            if len(keys) == 1:
+                if path[keys[0]]["value"] in allowed_properties:
+                    edges.append(to_edge(node_ids[src], node_ids[dest], path[keys[0]]["value"]))
+
+                continue
+
+            props = [path[k]["value"] for k in keys if k.startswith("pf") or k.startswith("ps")]
+
+            if len([p for p in props if p in allowed_properties]) != len(props):
+                continue
+
+            for start, end, prefix in ((src, dest, "f"), (dest, src, "s")):
+                current = start
+
+                for idx, prop in enumerate(sorted([k for k in list(path.keys()) if k.startswith(f"p{prefix}")])):
+                    obj = f"o{prefix}{idx + 1}"
+
+                    if obj in path.keys():
+                        edges.append(to_edge(node_ids[path[obj]["value"]], node_ids[current], path[prop]["value"]))
+                        current = path[obj]["value"]
+                    elif "middle" in path.keys():
+                        edges.append(to_edge(node_ids[path["middle"]["value"]], node_ids[current], path[prop]["value"]))
+                        break
+                    else:
+                        edges.append(to_edge(node_ids[current], node_ids[end], path[prop]["value"]))
+
+    return [json.loads(e) for e in set([json.dumps(e) for e in edges])]
+
+
+def synthetic_path_collections(max_distance: int, paths_per_query: int, nodes: int, properties: list) -> list:
+    """Returns random relationship query results following the
+    variable layouts of the relationship queries"""
+    query_config = RelationshipQueryConfig(
+        entity1IRI="http://w3id.org/um/cbcm/eu-cm-ontology#entity1",
+        entity2IRI="http://w3id.org/um/cbcm/eu-cm-ontology#entity2",
+        max_distance=max_distance
+    )
+
+    node_iris = [f"http://w3id.org/um/cbcm/eu-cm-ontology#node{i}" for i in range(nodes)]
+    path_collections = []
+
+    for block in relationships.get_queries(query_config).values():
+        for query in block:
+            layout = query["layout"]
+            paths = []
+
+            for _ in range(paths_per_query):
+                path = {
+                    var: {"type": "uri", "value": random.choice(node_iris)}
+                    for var in layout["nodes"]
+                }
+
+                for pred, _, _ in layout["edges"]:
+                    path[pred] = {"type": "uri", "value": random.choice(properties)}
+
+                paths.append(path)
+
+            path_collections.append({
+                "src": query["src"],
+                "dest": query["dest"],
+                "layout": layout,
+                "paths": paths
+            })
+
+    return path_collections
+
+
+def legacy_relationship_graph(path_collections: list, allowed_properties: list):
+    """Builds the nodes and edges dictionaries of the relationship graph
+    as the original port did. Used as benchmark baseline"""
+    node_ids = {}
+
+    for collection in path_collections:
+        for endpoint in (collection["src"], collection["dest"]):
+            node_ids.setdefault(endpoint, len(node_ids))
+
+        for path in collection["paths"]:
+            for key in list(path.keys()):
+                if "of" in key or "middle" in key or "os" in key:
+                    node_ids.setdefault(path[key]["value"], len(node_ids))
+
+    edges = legacy_relationship_edges(node_ids, path_collections, allowed_properties)
+
+    nodes = [{
+        "label": k.split("/")[-1],
+        "iri": k,
+        "id": node_ids[k],
+        "class": "MockClass",
+        "isEndpoint": False
+    } for k in node_ids.keys()]
+
+    return nodes, edges
+
+
+@click.group()
+def benchmark_graph():
+    pass
+
+
+@benchmark_graph.command()
+@click.option("--max-distance", type=int, default=4)
+@click.option("--paths-per-query", type=int, default=2000)
+@click.option("--nodes", type=int, default=5000)
+@click.option("--repeat", type=int, default=3)
+def build(max_distance, paths_per_query, nodes, repeat):
+    """Compares the time and peak memory needed to build and serialize
+    the relationship graph of synthetic query results with the legacy
+    dictionaries and with the interned graph"""
+    import tracemalloc
+
+    properties = json.loads(open("config.json").read())["allowed_object_properties"]
+    path_collections = synthetic_path_collections(max_distance, paths_per_query, nodes, properties)
+    endpoints = [path_collections[0]["src"], path_collections[0]["dest"]]
+    allowed_properties = frozenset(properties)
+
+    def build_legacy():
+        nodes, edges = legacy_relationship_graph(path_collections, properties)
+
+        return {"nodes": nodes, "edges": edges}
+
+    def build_graph():
+        graph = RelationshipGraph(endpoints)
+        add_path_collections(graph, path_collections, allowed_properties)
+
+        return graph.serialize()
+
+    for name, build in (("legacy", build_legacy), ("graph", build_graph)):
+        timings = []
+
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = build()
+            timings.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        build()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        click.echo(
+            f"{name}: {len(result['nodes'])} nodes, {len(result['edges'])} edges, "
+            f"{statistics.median(timings) * 1000:.1f} ms, peak {peak / 2 ** 20:.1f} MiB"
+        )
+
+
+@benchmark_graph.command()
+@click.option("--pairs", type=int, default=1000)
+@click.option("--properties", type=int, default=200)
+@click.option("--edges", type=int, default=100000)
+@click.option("--repeat", type=int, default=3)
+def merge(pairs, properties, edges, repeat):
+    """Compares the legacy edge merging with the merging of the graph
+    on random edges, with many properties joining the same node pairs"""
+    property_iris = [f"http://w3id.org/um/cbcm/eu-cm-ontology#property{i}" for i in range(properties)]
+    node_pairs = [(random.randrange(pairs), random.randrange(pairs)) for _ in range(pairs)]
+    random_edges = [
+        (*random.choice(node_pairs), random.choice(property_iris))
+        for _ in range(edges)
+    ]
+
+    graph = RelationshipGraph()
+
+    for idx in range(pairs):
+        graph.add_node(f"http://w3id.org/um/cbcm/eu-cm-ontology#node{idx}")
+
+    def merge_legacy():
+        return merge_edge_duplicates(graph.serialize_edges())
+
+    def merge_graph():
+        return graph.serialize_merged_edges()
+
+    start = time.perf_counter()
+
+    for sid, tid, iri in random_edges:
+        graph.add_edge(sid, tid, graph.add_property(iri))
+
+    click.echo(
+        f"{graph.edge_count} unique edges between {len(graph.edge_pairs)} node pairs, "
+        f"added and merged in {(time.perf_counter() - start) * 1000:.1f} ms"
+    )
+
+    for name, merge in (("legacy", merge_legacy), ("graph", merge_graph)):
+        timings = []
+
+        for _ in range(repeat):
+            start = time.perf_counter()
+            merged = merge()
+            timings.append(time.perf_counter() - start)
+
+        click.echo(
+            f"{name}: {len(merged)} edges, {sum(len(e['iris']) for e in merged)} properties, "
+            f"{statistics.median(timings) * 1000:.1f} ms"
+        )
+
+
+if __name__ == '__main__':
+    benchmark_graph()
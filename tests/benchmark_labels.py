@@ -0,0 +1,61 @@
+# Copyright (C) <2021>  <Kody Moodley and Walter Simoncini>
+# License: https://www.gnu.org/licenses/agpl-3.0.txt
+
+"""Measures the per-IRI cost of label lookups for chunks of increasing
+size, using entity IRIs from the SPARQL endpoint of the .env file.
+
+Run with `python -m tests.benchmark_labels`
+"""
+import time
+import click
+
+from api.app import app
+
+
+def legacy_label_query(iris: list) -> str:
+    """Label query of the original port, with one UNION branch per IRI.
+    Used as benchmark baseline"""
+    branches = " UNION\n".join([
+        f"{{ ?p rdfs:label | <http://w3id.org/um/cbcm/eu-cm-ontology#name> ?label FILTER(?p = <{iri}>)}}"
+        for iri in iris
+    ])
+
+    return f"""
+        SELECT * WHERE {{
+            {branches}
+            FILTER (lang(?label) = 'en' || lang(?label) = '')
+        }}
+    """
+
+
+@click.command()
+@click.option("--sizes", default="50,500,5000", help="Comma separated numbers of IRIs")
+@click.option("--legacy/--no-legacy", default=True, help="Also time the UNION based label query")
+def benchmark_labels(sizes, legacy):
+    sizes = [int(size) for size in sizes.split(",")]
+    iris = [entity["iri"] for entity in app.sparql.entities()][:max(sizes)]
+
+    for size in sizes:
+        chunk = iris[:size]
+
+        start = time.perf_counter()
+        app.sparql.label_for_entities(chunk)
+        elapsed = time.perf_counter() - start
+
+        report = f"{len(chunk)} IRIs: VALUES {elapsed / len(chunk) * 1000:.3f} ms/IRI"
+
+        if legacy:
+            start = time.perf_counter()
+
+            try:
+                app.sparql.client.query(legacy_label_query(chunk))
+                elapsed = time.perf_counter() - start
+                report = f"{report}, UNION {elapsed / len(chunk) * 1000:.3f} ms/IRI"
+            except Exception as ex:
+                report = f"{report}, UNION failed ({ex})"
+
+        click.echo(report)
+
+
+if __name__ == '__main__':
+    benchmark_labels()
@@ -0,0 +1,12 @@
+# Copyright (C) <2021>  <Kody Moodley and Walter Simoncini>
+# License: https://www.gnu.org/licenses/agpl-3.0.txt
+
+import os
+
+# Importing the api package creates the app, which reads the SPARQL
+# endpoint settings from the environment. Tests never query it
+os.environ.setdefault("SPARQL_ENDPOINT", "http://localhost:7200/repositories/test")
+os.environ.setdefault("SPARQL_USERNAME", "test")
+os.environ.setdefault("SPARQL_PASSWORD", "test")
+os.environ.setdefault("API_KEY", "test")
+os.environ.setdefault("ONTOLOGY_PREFIX", "http://w3id.org/um/cbcm/eu-cm-ontology#")
@@ -0,0 +1,67 @@
+# Copyright (C) <2021>  <Kody Moodley and Walter Simoncini>
+# License: https://www.gnu.org/licenses/agpl-3.0.txt
+
+from api.helpers.cache import (
+    LabelCache,
+    MemoryLabelCache,
+    SQLiteCacheBackend
+)
+
+
+def row_count(store) -> int:
+    return store._connection().execute(f"SELECT COUNT(*) FROM {store.TABLE}").fetchone()[0]
+
+
+def test_shared_cache_is_purged_every_interval(tmp_path, monkeypatch):
+    monkeypatch.setattr(SQLiteCacheBackend, "PURGE_INTERVAL", 10)
+    cache = SQLiteCacheBackend(str(tmp_path / "cache.sqlite3"), ttl=-1, max_entries=None)
+
+    for idx in range(9):
+        cache.set(f"key{idx}", idx)
+
+    # Expired entries are only deleted at the tenth write
+    assert row_count(cache) == 9
+
+    cache.set("key9", 9)
+
+    assert row_count(cache) == 0
+
+
+def test_shared_cache_keeps_the_newest_entries(tmp_path, monkeypatch):
+    monkeypatch.setattr(SQLiteCacheBackend, "PURGE_INTERVAL", 10)
+    cache = SQLiteCacheBackend(str(tmp_path / "cache.sqlite3"), max_entries=4)
+
+    for idx in range(10):
+        cache.set(f"key{idx}", idx)
+
+    assert row_count(cache) == 4
+    assert cache.get("key0") is None
+    assert [cache.get(f"key{idx}") for idx in range(6, 10)] == [6, 7, 8, 9]
+
+
+def test_label_cache_is_purged_every_interval(tmp_path, monkeypatch):
+    monkeypatch.setattr(LabelCache, "PURGE_INTERVAL", 10)
+    cache = LabelCache(str(tmp_path / "labels.sqlite3"), ttl=-1, negative_ttl=3600, max_entries=None)
+
+    cache.put_many("label", {f"iri{idx}": "label" for idx in range(5)}, missing=["missing"])
+
+    assert row_count(cache) == 6
+
+    cache.put_many("label", {f"iri{idx}": "label" for idx in range(5, 9)})
+
+    # Only the negative entry is not expired
+    assert row_count(cache) == 1
+    assert cache.get_many("label", ["missing", "iri0"]) == ({"missing": None}, ["iri0"])
+
+
+def test_memory_label_cache_is_purged_every_interval(monkeypatch):
+    monkeypatch.setattr(MemoryLabelCache, "PURGE_INTERVAL", 10)
+    cache = MemoryLabelCache(ttl=-1, negative_ttl=3600)
+
+    cache.put_many("label", {f"iri{idx}": "label" for idx in range(5)}, missing=["missing"])
+
+    assert len(cache._entries) == 6
+
+    cache.put_many("label", {f"iri{idx}": "label" for idx in range(5, 9)})
+
+    assert len(cache._entries) == 1
@@ -0,0 +1,330 @@
+# Copyright (C) <2021>  <Kody Moodley and Walter Simoncini>
+# License: https://www.gnu.org/licenses/agpl-3.0.txt
+
+import json
+import time
+import random
+import threading
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.request import parse_http_list, parse_keqv_list
+
+import pytest
+import rdflib
+
+from api.helpers.sparql.client import (
+    DIGEST_ALGORITHMS,
+    KEYSET_FILTER,
+    XSD,
+    QueryTimeoutError,
+    SPARQLClient,
+    parse_tsv_term
+)
+
+
+USERNAME, PASSWORD, REALM = "user", "password", "sparql"
+
+
+class FakeEndpoint(ThreadingHTTPServer):
+    """SPARQL endpoint answering each query with a single binding of
+    the query text. With an `algorithm` requests need digest
+    authentication, and the nonce changes every `nonce_uses` requests.
+    The "slow" query gets a response body sent over one second, and
+    TSV requests get the `tsv` response"""
+    daemon_threads = True
+
+    def __init__(self, algorithm: str = None, nonce_uses: int = None, tsv: str = "") -> None:
+        super().__init__(("127.0.0.1", 0), FakeEndpointHandler)
+
+        self.algorithm = algorithm
+        self.nonce_uses = nonce_uses
+        self.tsv = tsv
+
+        self.nonces = 0
+        self.nonce = "nonce0"
+        self.nonce_requests = 0
+        self.connections = set()
+        self.challenges = 0
+        self.stale_challenges = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}/repositories/test"
+
+    def client(self, **kwargs) -> SPARQLClient:
+        if self.algorithm is not None:
+            kwargs.update(username=USERNAME, password=PASSWORD)
+
+        return SPARQLClient(self.url, **kwargs)
+
+    def authorized(self, header: str):
+        """Checks a digest Authorization header. Returns None if the
+        nonce is not the current one"""
+        params = parse_keqv_list(parse_http_list(header.partition(" ")[2]))
+
+        with self.lock:
+            if params["nonce"] != self.nonce:
+                return None
+
+            self.nonce_requests += 1
+
+            if self.nonce_requests == self.nonce_uses:
+                self.nonces += 1
+                self.nonce = f"nonce{self.nonces}"
+                self.nonce_requests = 0
+
+        def digest(*parts):
+            return DIGEST_ALGORITHMS[self.algorithm](":".join(parts).encode("utf-8")).hexdigest()
+
+        expected = digest(
+            digest(USERNAME, REALM, PASSWORD),
+            params["nonce"],
+            params["nc"],
+            params["cnonce"],
+            "auth",
+            digest("POST", params["uri"])
+        )
+
+        return params["algorithm"] == self.algorithm and params["response"] == expected
+
+
+class FakeEndpointHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8")
+
+        with server.lock:
+            server.connections.add(self.client_address)
+
+        if server.algorithm is not None:
+            header = self.headers.get("Authorization")
+            authorized = None if header is None else server.authorized(header)
+
+            if not authorized:
+                return self.challenge(stale=header is not None and authorized is None)
+
+        query = parse_qs(body)["query"][0]
+        content_type = self.headers["Accept"]
+
+        if content_type == "text/tab-separated-values":
+            content = server.tsv.encode("utf-8")
+        else:
+            content = json.dumps({
+                "results": {"bindings": [{"query": {"type": "literal", "value": query}}]}
+            }).encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+
+        if query != "slow":
+            self.wfile.write(content)
+            return
+
+        try:
+            for idx in range(0, len(content), len(content) // 10):
+                self.wfile.write(content[idx:idx + len(content) // 10])
+                self.wfile.flush()
+                time.sleep(0.1)
+        except OSError:
+            # The client gave up
+            pass
+
+    def challenge(self, stale: bool):
+        with self.server.lock:
+            if stale:
+                self.server.stale_challenges += 1
+            else:
+                self.server.challenges += 1
+
+            nonce = self.server.nonce
+
+        header = f'Digest realm="{REALM}", nonce="{nonce}", qop="auth", algorithm={self.server.algorithm}'
+
+        if stale:
+            header = f"{header}, stale=true"
+
+        self.send_response(401)
+        self.send_header("WWW-Authenticate", header)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_endpoint(request):
+    server = FakeEndpoint(**getattr(request, "param", {}))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+def query_value(client: SPARQLClient, query: str, **kwargs) -> str:
+    return client.query(query, **kwargs)["results"]["bindings"][0]["query"]["value"]
+
+
+def test_connections_are_pooled(fake_endpoint):
+    client = fake_endpoint.client(pool_size=2)
+
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        results = list(executor.map(lambda idx: query_value(client, f"query{idx}"), range(30)))
+
+    assert results == [f"query{idx}" for idx in range(30)]
+    assert len(fake_endpoint.connections) <= 2
+
+
+@pytest.mark.parametrize("fake_endpoint", [
+    {"algorithm": "MD5"},
+    {"algorithm": "SHA-256"}
+], indirect=True)
+def test_digest_challenge_is_negotiated_once_per_connection(fake_endpoint):
+    client = fake_endpoint.client(pool_size=1)
+
+    assert [query_value(client, f"query{idx}") for idx in range(5)] == [f"query{idx}" for idx in range(5)]
+    assert fake_endpoint.challenges == 1
+
+
+@pytest.mark.parametrize("fake_endpoint", [{"algorithm": "MD5", "nonce_uses": 2}], indirect=True)
+def test_rotated_nonce_is_renegotiated(fake_endpoint):
+    client = fake_endpoint.client(pool_size=1)
+
+    assert [query_value(client, f"query{idx}") for idx in range(6)] == [f"query{idx}" for idx in range(6)]
+    assert fake_endpoint.challenges == 1
+    assert fake_endpoint.stale_challenges == 2
+
+
+def test_slow_response_is_aborted_at_the_timeout(fake_endpoint):
+    client = fake_endpoint.client(pool_size=1)
+    started_at = time.monotonic()
+
+    # Each part of the body arrives before the socket timeout, so only
+    # the watchdog stops the query
+    with pytest.raises(QueryTimeoutError):
+        client.query("slow", timeout=0.3)
+
+    assert time.monotonic() - started_at < 0.9
+
+    # The aborted connection is replaced
+    assert query_value(client, "query") == "query"
+    assert len(fake_endpoint.connections) == 2
+
+
+def test_close_closes_the_idle_connections(fake_endpoint):
+    client = fake_endpoint.client(pool_size=1)
+    query_value(client, "query")
+
+    connection = client._idle[0].connection
+    client.close()
+
+    assert client._idle == []
+    assert connection.sock is None
+
+
+@pytest.mark.parametrize("term, expected", [
+    ("<http://example.org/a>", {"type": "uri", "value": "http://example.org/a"}),
+    ("_:b0", {"type": "bnode", "value": "b0"}),
+    ('"plain"', {"type": "literal", "value": "plain"}),
+    ('"tab\\there\\nand \\"quotes\\" \\\\"', {"type": "literal", "value": 'tab\there\nand "quotes" \\'}),
+    ('"\\u00e9t\\U0001F600"', {"type": "literal", "value": "\u00e9t\U0001F600"}),
+    ('"chat"@fr', {"type": "literal", "value": "chat", "xml:lang": "fr"}),
+    ('"say \\"hi\\""@en-GB', {"type": "literal", "value": 'say "hi"', "xml:lang": "en-GB"}),
+    ('"7"^^<http://www.w3.org/2001/XMLSchema#int>', {"type": "literal", "value": "7", "datatype": f"{XSD}int"}),
+    ('"a@b"^^<http://example.org/type>', {"type": "literal", "value": "a@b", "datatype": "http://example.org/type"}),
+    ("42", {"type": "literal", "value": "42", "datatype": f"{XSD}integer"}),
+    ("-1.5", {"type": "literal", "value": "-1.5", "datatype": f"{XSD}decimal"}),
+    ("1.0e3", {"type": "literal", "value": "1.0e3", "datatype": f"{XSD}double"}),
+    ("true", {"type": "literal", "value": "true", "datatype": f"{XSD}boolean"})
+])
+def test_parse_tsv_term(term, expected):
+    assert parse_tsv_term(term) == expected
+
+
+def test_tsv_results_are_parsed(fake_endpoint):
+    fake_endpoint.tsv = "?s\t?label\t?o\n<http://example.org/a>\t\"a\\tb\"@en\t\n_:b1\t\t12\n"
+    client = fake_endpoint.client()
+
+    assert list(client.iter_bindings("SELECT * WHERE { ?s ?p ?o }")) == [
+        {
+            "s": {"type": "uri", "value": "http://example.org/a"},
+            "label": {"type": "literal", "value": "a\tb", "xml:lang": "en"}
+        },
+        {
+            "s": {"type": "bnode", "value": "b1"},
+            "o": {"type": "literal", "value": "12", "datatype": f"{XSD}integer"}
+        }
+    ]
+
+
+def keyset_client(seed: int):
+    """Returns a client whose TSV queries run on a random rdflib graph,
+    where some subjects have more triples than the page sizes, and the
+    list of the queries it runs"""
+    rnd = random.Random(seed)
+    subjects = [f"http://example.org/s{idx}" for idx in range(20)] + ['http://example.org/q"uo\\te']
+    graph = rdflib.Graph()
+
+    for subject in subjects:
+        for idx in range(rnd.choice([1, 2, 3, 7, 12])):
+            graph.add((
+                rdflib.URIRef(subject),
+                rdflib.URIRef(f"http://example.org/p{idx % 3}"),
+                rdflib.URIRef(f"http://example.org/o{idx}")
+            ))
+
+    client = SPARQLClient("http://127.0.0.1:1/sparql")
+    queries = []
+
+    def iter_tsv_bindings(query):
+        queries.append(query)
+
+        for row in graph.query(query):
+            yield {var: {"type": "uri", "value": str(value)} for var, value in row.asdict().items()}
+
+    client._iter_tsv_bindings = iter_tsv_bindings
+
+    return client, queries
+
+
+KEYSET_QUERY = f"""
+    SELECT ?s ?p ?o WHERE {{
+        ?s ?p ?o .
+        {KEYSET_FILTER}
+    }}
+    ORDER BY STR(?s) ?p ?o
+"""
+
+
+@pytest.mark.parametrize("page_size", [1, 2, 5, 7, 12, 1000])
+@pytest.mark.parametrize("seed", range(3))
+def test_keyset_pages_match_the_unpaginated_results(seed, page_size):
+    client, queries = keyset_client(seed)
+    results = list(client.iter_bindings(KEYSET_QUERY))
+
+    queries.clear()
+
+    assert list(client.iter_bindings(KEYSET_QUERY, page_size=page_size, key="s")) == results
+
+    # Runs of a key filling a whole page are fetched by a query of their own
+    longest_run = max(Counter(result["s"]["value"] for result in results).values())
+
+    assert any("STR(?s) =" in query for query in queries) == (longest_run >= page_size)
+
+
+def test_paginated_queries_need_the_keyset_filter():
+    client, _ = keyset_client(0)
+
+    with pytest.raises(ValueError):
+        list(client.iter_bindings("SELECT * WHERE { ?s ?p ?o } ORDER BY STR(?s)", page_size=10, key="s"))
@@ -0,0 +1,147 @@
+# Copyright (C) <2021>  <Kody Moodley and Walter Simoncini>
+# License: https://www.gnu.org/licenses/agpl-3.0.txt
+
+import random
+
+import pytest
+import rdflib
+
+from api.helpers import Deadline
+from api.helpers.sparql.adjacency import AdjacencyIndex
+from api.helpers.sparql.endpoint import SPARQLEndpoint
+from api.helpers.sparql.structs import (
+    QueryBatching,
+    RelationshipEngine
+)
+
+
+EX = "http://example.org/"
+ENTITIES = [f"{EX}entity{idx}" for idx in range(1, 4)]
+PROPERTIES = [f"{EX}property{idx}" for idx in range(3)]
+
+
+def random_triples(seed: int) -> list:
+    rnd = random.Random(seed)
+    nodes = ENTITIES + [f"{EX}node{idx}" for idx in range(8)]
+
+    return list(set(
+        (rnd.choice(nodes), rnd.choice(PROPERTIES), rnd.choice(nodes))
+        for _ in range(30)
+    ))
+
+
+def fixture_endpoint(triples: list, **kwargs) -> SPARQLEndpoint:
+    """Returns an endpoint whose relationship queries run on an rdflib
+    graph of triples, and whose adjacency index is built from them.
+    The queries it runs are listed in `endpoint.queries`"""
+    endpoint = SPARQLEndpoint(PROPERTIES, [], max_concurrent_queries=1, max_paths=None, **kwargs)
+    endpoint.queries = []
+
+    graph = rdflib.Graph()
+
+    for triple in triples:
+        graph.add(tuple(rdflib.URIRef(iri) for iri in triple))
+
+    def term(value):
+        return {"type": "literal" if isinstance(value, rdflib.Literal) else "uri", "value": str(value)}
+
+    def query_bindings(query, timeout=None):
+        endpoint.queries.append(query)
+
+        return [
+            {var: term(value) for var, value in row.asdict().items()}
+            for row in graph.query(query)
+        ]
+
+    endpoint._query_bindings = query_bindings
+    endpoint.adjacency.index = AdjacencyIndex.from_triples(triples)
+
+    return endpoint
+
+
+def graph_edges(graph) -> set:
+    return set(
+        (graph.iris[sid], graph.iris[tid], graph.properties[prop])
+        for sid, tid, prop in zip(graph.edge_sources, graph.edge_targets, graph.edge_props)
+    )
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_engines_find_the_same_graph(seed):
+    endpoint = fixture_endpoint(random_triples(seed))
+
+    graphs = [
+        endpoint.find_relationships(ENTITIES[0], ENTITIES[1], 4, engine=engine)[0]
+        for engine in (RelationshipEngine.SPARQL, RelationshipEngine.INDEX)
+    ]
+
+    assert set(graphs[0].iris) == set(graphs[1].iris)
+    assert graph_edges(graphs[0]) == graph_edges(graphs[1])
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_engines_find_the_same_multi_entity_graph(seed):
+    endpoint = fixture_endpoint(random_triples(seed))
+
+    graphs = [
+        endpoint.find_relationships_multi(ENTITIES, 3, engine=engine)[0]
+        for engine in (RelationshipEngine.SPARQL, RelationshipEngine.INDEX)
+    ]
+
+    assert set(graphs[0].iris) == set(graphs[1].iris)
+    assert graph_edges(graphs[0]) == graph_edges(graphs[1])
+
+
+def test_index_engine_follows_the_query_patterns():
+    e1, e2 = ENTITIES[:2]
+    a, b, c, d = (f"{EX}node{idx}" for idx in range(4))
+    p = PROPERTIES[0]
+
+    # e1 -> a -> e2 is a direct connection and e1 -> b <- e2 a middle
+    # object one, while e1 -> c <- d -> e2 is not a pattern of the queries
+    endpoint = fixture_endpoint([
+        (e1, p, a), (a, p, e2),
+        (e1, p, b), (e2, p, b),
+        (e1, p, c), (d, p, c), (d, p, e2)
+    ])
+    graph, _ = endpoint.find_relationships(e1, e2, 3, engine=RelationshipEngine.INDEX)
+
+    assert set(graph.iris) == {e1, e2, a, b}
+
+    # Intermediate edges of direct connections point towards the source
+    # and the ones of middle object paths towards the entities
+    assert graph_edges(graph) == {(a, e1, p), (a, e2, p), (b, e1, p), (b, e2, p)}
+
+
+def test_index_engine_stops_at_the_deadline():
+    endpoint = fixture_endpoint(random_triples(0))
+    deadline = Deadline(0)
+
+    graph, _ = endpoint.find_relationships(
+        ENTITIES[0],
+        ENTITIES[1],
+        4,
+        engine=RelationshipEngine.INDEX,
+        deadline=deadline
+    )
+
+    assert deadline.expired
+    assert graph.edge_count == 0
+
+
+@pytest.mark.parametrize("query_batching, requests", [
+    (QueryBatching.NONE, 30),
+    # One request per pair and per entity arms at each distance
+    (QueryBatching.DISTANCE, 15),
+    (QueryBatching.SEARCH, 1)
+])
+def test_batched_queries_are_demultiplexed(query_batching, requests):
+    triples = random_triples(0)
+    expected, _ = fixture_endpoint(triples).find_relationships_multi(ENTITIES, 3)
+
+    endpoint = fixture_endpoint(triples, query_batching=query_batching)
+    graph, _ = endpoint.find_relationships_multi(ENTITIES, 3)
+
+    assert len(endpoint.queries) == requests
+    assert set(graph.iris) == set(expected.iris)
+    assert graph_edges(graph) == graph_edges(expected)
@@ -0,0 +1,122 @@
+# Copyright (C) <2021>  <Kody Moodley and Walter Simoncini>
+# License: https://www.gnu.org/licenses/agpl-3.0.txt
+
+import random
+
+import pytest
+import rdflib
+
+from api.helpers.sparql import relationships
+from api.helpers.sparql.query_utils import uri, expand_terms
+from api.helpers.sparql.structs import (
+    QueryCyclesStrategy,
+    RelationshipQueryConfig
+)
+
+
+EX = "http://example.org/"
+
+
+def legacy_generate_filter(query_config, variables: dict):
+    """Filter generator of the original port, which compares every
+    ordered pair of intermediate objects"""
+    filter_terms = []
+
+    for prop in variables["pred"]:
+        for ignored_prop in query_config.ignored_properties:
+            filter_terms.append(f"{prop} != {uri(ignored_prop)} ")
+
+    for obj in variables["obj"]:
+        filter_terms.append(f"!isLiteral({obj})")
+
+        for ignored_obj in query_config.ignored_objects:
+            filter_terms.append(f"{obj} != {uri(ignored_obj)} ")
+
+        if query_config.avoid_cycles != QueryCyclesStrategy.NONE:
+            filter_terms.append(f"{obj} != {uri(query_config.entity1IRI)} ")
+            filter_terms.append(f"{obj} != {uri(query_config.entity2IRI)} ")
+
+            if query_config.avoid_cycles == QueryCyclesStrategy.NO_INTERMEDIATE_DUPLICATES:
+                for other_obj in variables["obj"]:
+                    if obj != other_obj:
+                        filter_terms.append(f"{obj} != {other_obj} ")
+
+    return f"FILTER {expand_terms(filter_terms, '&&')}. "
+
+
+def filter_query_config(max_distance: int, avoid_cycles: QueryCyclesStrategy) -> RelationshipQueryConfig:
+    return RelationshipQueryConfig(
+        entity1IRI=f"{EX}entity1",
+        entity2IRI=f"{EX}entity2",
+        ignored_objects=[f"{EX}ignored"],
+        ignored_properties=[f"{EX}ignoredProperty"],
+        avoid_cycles=avoid_cycles,
+        max_distance=max_distance
+    )
+
+
+def legacy_queries(query_config: RelationshipQueryConfig, monkeypatch) -> dict:
+    """Returns the queries of query_config generated with the legacy
+    filter. Query templates are memoized, so they are rebuilt around
+    the generation of the legacy queries"""
+    relationships.query_template.cache_clear()
+
+    with monkeypatch.context() as patch:
+        patch.setattr(relationships, "generate_filter", legacy_generate_filter)
+        queries = relationships.get_queries(query_config)
+
+    relationships.query_template.cache_clear()
+
+    return queries
+
+
+def random_graph(seed: int) -> rdflib.Graph:
+    rnd = random.Random(seed)
+    nodes = [f"{EX}entity1", f"{EX}entity2", f"{EX}ignored"] + [f"{EX}node{idx}" for idx in range(6)]
+    properties = [f"{EX}property{idx}" for idx in range(3)] + [f"{EX}ignoredProperty"]
+
+    graph = rdflib.Graph()
+
+    for _ in range(40):
+        graph.add((
+            rdflib.URIRef(rnd.choice(nodes)),
+            rdflib.URIRef(rnd.choice(properties)),
+            rdflib.URIRef(rnd.choice(nodes))
+        ))
+
+    graph.add((rdflib.URIRef(f"{EX}node0"), rdflib.URIRef(f"{EX}property0"), rdflib.Literal("literal")))
+
+    return graph
+
+
+def query_results(graph: rdflib.Graph, query: str) -> set:
+    return set(
+        frozenset((key, str(value)) for key, value in row.asdict().items())
+        for row in graph.query(query)
+    )
+
+
+@pytest.mark.parametrize("avoid_cycles", [
+    QueryCyclesStrategy.NONE,
+    QueryCyclesStrategy.NO_INTERMEDIATE_DUPLICATES
+])
+def test_filters_match_legacy_filters(avoid_cycles, monkeypatch):
+    query_config = filter_query_config(3, avoid_cycles)
+    legacy = legacy_queries(query_config, monkeypatch)
+    compact = relationships.get_queries(query_config)
+
+    for seed in range(3):
+        graph = random_graph(seed)
+
+        for distance in compact:
+            for legacy_query, query in zip(legacy[distance], compact[distance]):
+                assert query_results(graph, query["query"]) == query_results(graph, legacy_query["query"])
+
+
+def test_filters_are_smaller_than_legacy_filters(monkeypatch):
+    query_config = filter_query_config(6, QueryCyclesStrategy.NO_INTERMEDIATE_DUPLICATES)
+    legacy = legacy_queries(query_config, monkeypatch)
+    compact = relationships.get_queries(query_config)
+
+    for distance in range(2, 7):
+        assert sum(len(q["query"]) for q in compact[distance]) < sum(len(q["query"]) for q in legacy[distance])
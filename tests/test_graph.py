@@ -0,0 +1,160 @@
+# Copyright (C) <2021>  <Kody Moodley and Walter Simoncini>
+# License: https://www.gnu.org/licenses/agpl-3.0.txt
+
+import random
+
+from api.helpers import relabel_transactions
+from api.helpers.sparql.graph import RelationshipGraph
+
+
+ONTOLOGY = "http://w3id.org/um/cbcm/eu-cm-ontology#"
+
+
+def merge_edge_duplicates(edges: list, label_sep="|"):
+    """The edge merging removed from SPARQLEndpoint, kept as reference
+    and as baseline of tests/benchmark_graph.py"""
+    edges_dict = {}
+
+    for edge in edges:
+        key = f"{edge['sid']}-{edge['tid']}"
+
+        if key in edges_dict and edge["label"] not in edges_dict[key]["label"]:
+            edges_dict[key]["iris"].append(edge["iri"])
+            edges_dict[key]["label"].append(edge["label"])
+        else:
+            edges_dict[key] = {
+                "sid": edge["sid"],
+                "tid": edge["tid"],
+                "iris": [edge["iri"]],
+                "label": [edge["label"]]
+            }
+
+    for _, edge in edges_dict.items():
+        edge["label"] = f" {label_sep} ".join(edge["label"])
+
+    return [v for _, v in edges_dict.items()]
+
+
+def make_graph(nodes: int) -> RelationshipGraph:
+    graph = RelationshipGraph([f"{ONTOLOGY}node0", f"{ONTOLOGY}node1"])
+
+    for idx in range(2, nodes):
+        graph.add_node(f"{ONTOLOGY}node{idx}")
+
+    return graph
+
+
+def add_edge(graph: RelationshipGraph, sid: int, tid: int, prop: str) -> bool:
+    return graph.add_edge(sid, tid, graph.add_property(f"{ONTOLOGY}{prop}"))
+
+
+def test_duplicate_edges_are_merged_per_direction():
+    graph = make_graph(2)
+
+    assert add_edge(graph, 0, 1, "owns")
+    assert not add_edge(graph, 0, 1, "owns")
+    assert add_edge(graph, 1, 0, "owns")
+    assert not add_edge(graph, 1, 0, "owns")
+
+    assert graph.edge_count == 2
+    assert graph.serialize_merged_edges() == [
+        {"sid": 0, "tid": 1, "iris": [f"{ONTOLOGY}owns"], "label": "eu-cm-ontology#owns"},
+        {"sid": 1, "tid": 0, "iris": [f"{ONTOLOGY}owns"], "label": "eu-cm-ontology#owns"}
+    ]
+
+
+def test_properties_of_a_node_pair_are_merged_in_order():
+    graph = make_graph(3)
+
+    for prop in ("owns", "employs", "owns", "hasMember"):
+        add_edge(graph, 0, 2, prop)
+
+    add_edge(graph, 2, 1, "partOf")
+
+    assert graph.serialize_merged_edges() == [{
+        "sid": 0,
+        "tid": 2,
+        "iris": [f"{ONTOLOGY}owns", f"{ONTOLOGY}employs", f"{ONTOLOGY}hasMember"],
+        "label": "eu-cm-ontology#owns | eu-cm-ontology#employs | eu-cm-ontology#hasMember"
+    }, {
+        "sid": 2,
+        "tid": 1,
+        "iris": [f"{ONTOLOGY}partOf"],
+        "label": "eu-cm-ontology#partOf"
+    }]
+
+
+def test_properties_sharing_a_label_are_listed_once():
+    graph = make_graph(2)
+
+    add_edge(graph, 0, 1, "owns")
+    add_edge(graph, 0, 1, "ownedBy")
+    add_edge(graph, 0, 1, "employs")
+
+    graph.set_labels({
+        f"{ONTOLOGY}owns": "owner",
+        f"{ONTOLOGY}ownedBy": "owner",
+        f"{ONTOLOGY}employs": "employer"
+    })
+
+    # The removed merge replaced the merged edge with a new one when a
+    # label was repeated, losing the properties merged before it
+    assert graph.serialize_merged_edges() == [{
+        "sid": 0,
+        "tid": 1,
+        "iris": [f"{ONTOLOGY}owns", f"{ONTOLOGY}employs"],
+        "label": "owner | employer"
+    }]
+
+
+def test_relabelled_transactions():
+    graph = make_graph(3)
+
+    add_edge(graph, 0, 2, "isTransactionInputOf")
+    add_edge(graph, 0, 2, "isTransactionInputOf")
+    add_edge(graph, 1, 2, "isTransactionResultOf")
+    add_edge(graph, 1, 2, "hasMergingCompany")
+
+    graph.set_labels({
+        f"{ONTOLOGY}node2": "TX42",
+        f"{ONTOLOGY}isTransactionInputOf": "input of"
+    })
+    graph.set_classes({
+        f"{ONTOLOGY}node0": f"{ONTOLOGY}Company",
+        f"{ONTOLOGY}node2": f"{ONTOLOGY}CrossBorderMerger"
+    })
+
+    relabel_transactions(graph)
+
+    serialized = graph.serialize()
+
+    assert [node["label"] for node in serialized["nodes"]] == [
+        "eu-cm-ontology#node0",
+        "eu-cm-ontology#node1",
+        "CrossBorderMerger#TX42"
+    ]
+    assert serialized["edges"] == merge_edge_duplicates(graph.serialize_edges())
+    assert serialized["edges"] == [{
+        "sid": 0,
+        "tid": 2,
+        "iris": [f"{ONTOLOGY}isTransactionInputOf"],
+        "label": "input of"
+    }, {
+        "sid": 1,
+        "tid": 2,
+        "iris": [f"{ONTOLOGY}isTransactionResultOf", f"{ONTOLOGY}hasMergingCompany"],
+        "label": "eu-cm-ontology#isTransactionResultOf | eu-cm-ontology#hasMergingCompany"
+    }]
+
+
+def test_merge_matches_removed_merge():
+    rnd = random.Random(0)
+    graph = make_graph(30)
+    properties = [f"property{idx}" for idx in range(20)]
+
+    for _ in range(2000):
+        add_edge(graph, rnd.randrange(30), rnd.randrange(30), rnd.choice(properties))
+
+    # The removed merge received the deduplicated edges
+    assert graph.serialize_merged_edges() == merge_edge_duplicates(graph.serialize_edges())
+    assert sum(len(edge["iris"]) for edge in graph.serialize_merged_edges()) == graph.edge_count